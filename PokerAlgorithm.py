@@ -1,16 +1,73 @@
 #!/usr/bin/python
 # -*- encoding: utf-8 -*-
 
+import time
 from PokerUtils import *
+from PokerPreflop import PreflopTable
 
 class PokerAlgorithm:
-    def __init__(self, mode, pokerState):
+    HOLD_GROUPS = [ # 0-6
+        ['87', '53s', 'A9', 'Q9', '76', '42s', '32s', '96s','85s', 'J8',
+         'J7s', '65', '54', '74s', 'K9', 'T8', '76', '65s', '54s', '86s'],
+        ['66', 'J8s', '98s', 'T8s', '44', 'J9', '43s', '75s', 'T9', '33',
+         '98', '64s', '22', 'K8s', 'K7s', 'K6s', 'K5s', 'K4s', 'K3s',
+         'K2s', 'Q8s', '55', '87s', '97s'],
+        ['77', 'Q9s', 'KJ', 'QJ', 'JTs', 'A7s', 'A6s', 'A5s', 'A4s',
+         'A3s', 'A2s', 'J9s', 'T9s', 'K9s', 'KT', 'QT'],
+        ['A8s', 'KQ', '88', 'QTs', 'A9s', 'AT', 'AJ', 'JTs'],
+        ['99', 'QJs', 'KJs', 'KTs'],
+        ['JJ', 'TT', 'AJs', 'ATs', 'AK', 'AQ', 'KQs'],
+        ['AA', 'KK', 'QQ', 'AKs', 'AQs']
+        ]
+
+    # hand class (see PreflopTable) => group, first listed group wins
+    CLASS_GROUP = [-1] * 169
+    for _cls in range(169):
+        for _group, _types in enumerate(HOLD_GROUPS):
+            if PreflopTable.className(_cls) in _types:
+                CLASS_GROUP[_cls] = _group
+                break
+    del _cls, _group, _types
+
+    # workers: equity process pool size or shared EquityPool, see PokerUtils
+    # speculate: work on equity in the background between messages
+    def __init__(self, mode, pokerState, workers = 0, speculate = True):
         self.ps = pokerState
-        self.pu = PokerUtils()
+        self.pu = PokerUtils(workers)
+        self.speculator = EquitySpeculator() if speculate else None
+        # opponents still in the hand as of our last inquire
+        self.playerCount = 0
+        self.isFolded = False
+        try:
+            self.preflop = PreflopTable.shared()
+        except (IOError, ValueError):
+            self.preflop = None
+        # opponents => class => group, None without preflop.bin
+        self.equityGroups = None if self.preflop is None else self.__equity_groups()
         self.maxHands = 600
         self.SB = 20
         self.isBluffed = False
         self.DEBUG = False
+        # last RRRound adaptiveHS: (HS, samples, (low, high))
+        self.lastHS = None
+        # seconds to answer an inquire per round; equity work stops at
+        # equityShare of it, PokerMessage sends fallbackReply at all of it
+        self.budgets = {
+            'hold': 0.2,
+            'flop': 0.4,
+            'turn': 0.4,
+            'river': 0.4
+            }
+        self.equityShare = 0.7
+        # False lets equity work run to the end whatever the clock says,
+        # so seeded decisions don't depend on the machine's speed
+        self.useDeadline = True
+        # what the decision was made on: holdRound 'group', RRRound
+        # 'LR', 'HS', 'RR' as far as it got
+        self.inputs = {}
+        # per inquire: {'round', 'budget', 'used', 'reply', 'fallback',
+        #               'inputs'}
+        self.decisions = []
         self.activeValue = {
             'all_in': 5,
             'raise': 3,
@@ -26,58 +83,50 @@ class PokerAlgorithm:
             'river': self.RRRound
             }
         
-    def __getHoldType(self, hold):
-        hold = list(hold)
-        if hold[0][1] < hold[1][1]:
-            hold[0], hold[1] = hold[1], hold[0]
-        _type = ''
-        for card in hold:
-            if card[1] >= 10:
-                _type += ['T', 'J', 'Q', 'K', 'A'][card[1] - 10]
-            else:
-                _type += str(card[1])
-        if hold[0][0] == hold[1][0]:
-            _type += 's'
-        return _type
-    
-    #hold: ((string<color>, int<point>), (string<color>, int<point>))
-    def holdGroup(self, hold):
-        types = [ # 0-6
-            ['87', '53s', 'A9', 'Q9', '76', '42s', '32s', '96s','85s', 'J8',
-             'J7s', '65', '54', '74s', 'K9', 'T8', '76', '65s', '54s', '86s'],
-            ['66', 'J8s', '98s', 'T8s', '44', 'J9', '43s', '75s', 'T9', '33',
-             '98', '64s', '22', 'K8s', 'K7s', 'K6s', 'K5s', 'K4s', 'K3s',
-             'K2s', 'Q8s', '55', '87s', '97s'],
-            ['77', 'Q9s', 'KJ', 'QJ', 'JTs', 'A7s', 'A6s', 'A5s', 'A4s',
-             'A3s', 'A2s', 'J9s', 'T9s', 'K9s', 'KT', 'QT'],
-            ['A8s', 'KQ', '88', 'QTs', 'A9s', 'AT', 'AJ', 'JTs'],
-            ['99', 'QJs', 'KJs', 'KTs'],
-            ['JJ', 'TT', 'AJs', 'ATs', 'AK', 'AQ', 'KQs'],
-            ['AA', 'KK', 'QQ', 'AKs', 'AQs']
-            ]
-        holdType = self.__getHoldType(hold)
-        for i, _type in enumerate(types):
-            if holdType in _type:
-                return i
-        return -1
+    # The classes ranked by equity against 1-7 opponents, cut into groups
+    # as big as HOLD_GROUPS' from group 6 down; the rest get -1
+    def __equity_groups(self):
+        sizes = [PokerAlgorithm.CLASS_GROUP.count(group)
+                 for group in range(len(PokerAlgorithm.HOLD_GROUPS))]
+        equityGroups = [None]
+        for opponents in range(1, PreflopTable.MAX_OPPONENTS + 1):
+            order = sorted(range(169), key = lambda cls:
+                           -self.preflop.classEquity(cls, opponents))
+            classGroup = [-1] * 169
+            start = 0
+            for group in reversed(range(len(sizes))):
+                for cls in order[start:start + sizes[group]]:
+                    classGroup[cls] = group
+                start += sizes[group]
+            equityGroups.append(classGroup)
+        return equityGroups
 
-    # players: (pid, jetton, money, bet, <action>)
+    # hold: (int<card>, int<card>)
+    # opponents: by equity against that many, None for the fixed HOLD_GROUPS
+    def holdGroup(self, hold, opponents = None):
+        cls = PreflopTable.holdClass(hold)
+        if opponents is None or self.equityGroups is None:
+            return PokerAlgorithm.CLASS_GROUP[cls]
+        opponents = min(max(opponents, 1), PreflopTable.MAX_OPPONENTS)
+        return self.equityGroups[opponents][cls]
+
+    # players: (PokerTools.ActionRow, ...)
     def __call_bet(self, players):
         maxBet = 0
         beted = 0
         for player in players:
-            if int(player[3]) > maxBet:
-                maxBet = int(player[3])
-            if player[0] == self.ps.getMyPID():
-                beted = int(player[3])
+            if player.bet > maxBet:
+                maxBet = player.bet
+            if player.pid == self.ps.getMyPID():
+                beted = player.bet
         return maxBet - beted
         
     def __get_player_count(self, players):
         count = 0
         for player in players:
-            if player[0] == self.ps.getMyPID():
+            if player.pid == self.ps.getMyPID():
                 continue
-            if player[4] != 'fold':
+            if player.action != 'fold':
                 count += 1
         return count
 
@@ -91,14 +140,16 @@ class PokerAlgorithm:
         onlines = self.ps.getOnlines()
         if len(players) <= 2 * len(onlines) / 3:
             return False
-        blind = []
+        blind = set()
+        acted = set()
         for player in players:
-            if player[4] == 'blind':
-                blind.append(player[0])
-            if player[4] in ['raise', 'all_in']:
+            if player.action == 'blind':
+                blind.add(player.pid)
+            if player.action in ('raise', 'all_in'):
                 return False
+            acted.add(player.pid)
         for pid in onlines:
-            if pid in blind or pid not in [player[0] for player in players]:
+            if pid in blind or pid not in acted:
                 if self.ps.averageActive(pid) > 0.0:
                     return False
         return True
@@ -110,10 +161,11 @@ class PokerAlgorithm:
     
     # players: (pid, jetton, money, bet, <action>)
     def holdRound(self, players):
-        group = self.holdGroup(self.ps.getHold())
         bet = self.__call_bet(players)
         pot = self.ps.getPot()
         onlines = self.ps.getOnlines()
+        group = self.holdGroup(self.ps.getHold(), len(onlines))
+        self.inputs['group'] = group
         
         if len(onlines) == 1 or self.DEBUG:
             if group >= 2:
@@ -168,7 +220,11 @@ class PokerAlgorithm:
         hold = self.ps.getHold()
         ftr = self.ps.getFTR()
         playerCount = self.__get_player_count(players)
+        if self.speculator is not None:
+            boardRanks, exact, results, table = self.speculator.take(hold, ftr)
+            self.pu.merge(hold, ftr, boardRanks, exact, results, table)
         LR = self.pu.loseRate(hold, ftr)
+        self.inputs['LR'] = LR
         
         if len(onlines) == 1 or self.DEBUG:
             if LR < 25.0:
@@ -189,20 +245,33 @@ class PokerAlgorithm:
         if bet == 0:
             return 'check'
 
-        RR, HS = self.pu.RR(hold, ftr, playerCount, bet, pot)
+        adjust = 0.0
+        if self.ps.getMyMoneyAndJetton() < 25 * self.SB or \
+           self.__is_money_enough():
+            adjust = -1.0
+        elif len(onlines) <= 3:
+            adjust = 0.5
+        lowMoney = self.ps.getMyMoneyAndJetton() - bet < 6 * self.SB
+
+        # HS values where the decision below changes, sampling stops as
+        # soon as HS is clearly on one side of all of them
+        thresholds = [(rr - adjust) * bet / (bet + pot) for rr in (1.0, 1.5, 2.0, 4.0)]
+        if lowMoney:
+            thresholds.append(0.5)
+        HS, samples, interval = self.pu.adaptiveHS(hold, ftr, playerCount, thresholds)
+        self.lastHS = (HS, samples, interval)
+        RR = HS * (bet + pot) / bet
+        self.inputs['HS'] = HS
         #print('===========================')
         #print hold, ftr, playerCount, bet, pot
-        #print RR, HS
+        #print RR, HS, samples, interval
         #print LR
         #print('===========================')
-        if HS < 0.5 and (self.ps.getMyMoneyAndJetton() - bet < 6 * self.SB):
+        if HS < 0.5 and lowMoney:
             return 'fold'
         
-        if self.ps.getMyMoneyAndJetton() < 25 * self.SB or \
-           self.__is_money_enough():
-            RR -= 1.0
-        elif len(onlines) <= 3:
-            RR += 0.5
+        RR += adjust
+        self.inputs['RR'] = RR
             
         if RR < 1.0:
             return 'fold'
@@ -220,5 +289,66 @@ class PokerAlgorithm:
             return self.__random_req([0, 1, 9], bet)
 
 
+    def getBudget(self):
+        return self.budgets.get(self.ps.getRound(), min(self.budgets.values()))
+
+    # Safe answer when the decision misses its budget
+    def fallbackReply(self, players):
+        return 'check' if self.__call_bet(players) == 0 else 'fold'
+
+    # Called once PokerState has the new street: hand the board to the
+    # speculator for the opponent counts we will likely face. Preflop
+    # needs no equity, so a new hand (or its end) only drops old work.
+    def speculate(self):
+        if self.speculator is None:
+            return
+        if self.ps.getRound() == 'hold':
+            self.playerCount = len(self.ps.getOnlines())
+            self.isFolded = False
+        if self.ps.getRound() in ('flop', 'turn', 'river') and \
+           self.playerCount > 0 and not self.isFolded:
+            counts = range(self.playerCount, max(self.playerCount - 2, 0), -1)
+            self.speculator.start(self.ps.getHold(), self.ps.getFTR(), counts)
+        else:
+            self.speculator.cancel()
+
+    # We are out of the hand
+    def folded(self):
+        self.isFolded = True
+        if self.speculator is not None:
+            self.speculator.cancel()
+
+    # The pot was won, with or without a showdown
+    def handOver(self):
+        if self.speculator is not None:
+            self.speculator.cancel()
+
+    def close(self):
+        if self.speculator is not None:
+            self.speculator.close()
+        self.pu.close()
+
     def replyHandler(self, players):
-        return self.entries[self.ps.getRound()](players)
+        start = time.time()
+        budget = self.getBudget()
+        self.pu.deadline = start + budget * self.equityShare if self.useDeadline else None
+        self.playerCount = self.__get_player_count(players)
+        if self.speculator is not None:
+            self.speculator.pause()
+        self.inputs = {}
+        try:
+            reply = self.entries[self.ps.getRound()](players)
+            if reply == 'fold':
+                self.folded()
+        finally:
+            if self.speculator is not None:
+                self.speculator.resume()
+        self.decisions.append({
+            'round': self.ps.getRound(),
+            'budget': budget,
+            'used': time.time() - start,
+            'reply': reply,
+            'fallback': False,
+            'inputs': self.inputs
+            })
+        return reply
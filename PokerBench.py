@@ -0,0 +1,400 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+
+import StringIO, argparse, collections, json, multiprocessing, platform, random, re, sys, time
+from deuces import Deck, Evaluator
+from deuces.lookup import LookupTable
+from PokerUtils import COLORS, POINTS, PokerUtils
+from PokerTools import MessageFramer, PokerMessage, PokerState, parseMessage
+from PokerSelfPlay import SelfPlay
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# name => seconds per unit of work, filled in by the bench functions;
+# lower is better for every entry. A bench run several times keeps its
+# best time, the one least disturbed by the rest of the machine.
+RESULTS = collections.OrderedDict()
+
+def record(name, seconds):
+    RESULTS[name] = min(seconds, RESULTS.get(name, seconds))
+    return seconds
+
+# Return: seconds per call of func(arg) over all args
+def timeCalls(func, args):
+    start = time.time()
+    for arg in args:
+        func(arg)
+    return (time.time() - start) / len(args)
+
+def benchEvaluator(count = 20000, seed = 0):
+    random.seed(seed)
+    start = time.time()
+    LookupTable()
+    buildFive = record('lookup.build.five', time.time() - start)
+    start = time.time()
+    LookupTable(direct = True)
+    buildDirect = record('lookup.build.direct', time.time() - start)
+    start = time.time()
+    LookupTable.load(LookupTable.DEFAULT_FILE)
+    load = record('lookup.load', time.time() - start)
+    print('tables: build 5 cards %.1fms, build direct %.1fms, load %.2fms' %
+          (buildFive * 1000, buildDirect * 1000, load * 1000))
+
+    combinations = Evaluator()
+    direct = Evaluator('direct')
+
+    for size in (5, 6, 7):
+        hands = [Deck().draw(size) for idx in range(count)]
+        for hand in hands:
+            assert combinations.evaluate(hand) == direct.evaluate(hand)
+        old = record('evaluate.combinations.%d' % size, timeCalls(combinations.evaluate, hands))
+        new = record('evaluate.direct.%d' % size, timeCalls(direct.evaluate, hands))
+        print('%d cards: combinations %.2fus, direct %.2fus, x%.1f' %
+              (size, old * 1e6, new * 1e6, old / new))
+
+def benchHandState(count = 20000, seed = 0):
+    random.seed(seed)
+    evaluator = Evaluator('direct')
+    hands = [random.sample(range(52), 7) for idx in range(count)]
+    states = [evaluator.hand_state(hand[:5]) for hand in hands]
+    full = record('evaluate.index.7', timeCalls(evaluator.evaluate_index, hands))
+    start = time.time()
+    for state, hand in zip(states, hands):
+        state.evaluate_with(hand[5], hand[6])
+    incremental = record('evaluate.handState.with', (time.time() - start) / count)
+    print('board + hold: evaluate_index %.2fus, HandState.evaluate_with %.2fus' %
+          (full * 1e6, incremental * 1e6))
+
+def benchBatch(count = 50000, seed = 0):
+    random.seed(seed)
+    evaluator = Evaluator('direct')
+    for size in (5, 6, 7):
+        hands = [Deck().draw(size) for idx in range(count)]
+        array = np.array(hands, dtype = np.int64)
+        evaluator.evaluate_batch(array[:1])
+        start = time.time()
+        ranks = evaluator.evaluate_batch(array)
+        batch = record('evaluate.batch.%d' % size, (time.time() - start) / count)
+        single = timeCalls(evaluator.evaluate, hands)
+        assert list(ranks) == [evaluator.evaluate(hand) for hand in hands]
+        print('%d cards x %d: evaluate %.2fus, evaluate_batch %.2fus per hand' %
+              (size, count, single * 1e6, batch * 1e6))
+
+def benchLoseRate(count = 20, seed = 0):
+    random.seed(seed)
+    pu = PokerUtils(seed = seed)
+    for street, size in (('flop', 3), ('turn', 4), ('river', 5)):
+        spots = []
+        for idx in range(count):
+            cards = random.sample(range(52), size + 2)
+            spots.append((tuple(cards[:2]), tuple(cards[2:])))
+        first = record('loseRate.%s.new' % street, timeCalls(lambda spot: pu.loseRate(*spot), spots))
+        again = record('loseRate.%s.same' % street,
+                       timeCalls(lambda spot: pu.loseRate(*spot), [spots[-1]] * count))
+        print('loseRate %s: new board %.2fms, same board %.3fms' %
+              (street, first * 1000, again * 1000))
+
+def benchExact(count = 20, seed = 0):
+    random.seed(seed)
+    pu = PokerUtils(seed = seed)
+    pu.cache.maxEntries = 0
+    for street, size in (('turn', 4), ('river', 5)):
+        for playerCount in (1, 2):
+            spots = []
+            for idx in range(count):
+                cards = random.sample(range(52), size + 2)
+                spots.append((tuple(cards[:2]), tuple(cards[2:]), playerCount))
+            if pu.exactOdds(*spots[0]) is None:
+                continue
+            sampled = timeCalls(lambda spot: pu.emulateHS(*spot), spots)
+            exact = record('exactOdds.%s.%d' % (street, playerCount),
+                           timeCalls(lambda spot: pu.exactOdds(*spot), spots))
+            print('HS %s x%d: %d trials %.1fms, exact %.1fms' %
+                  (street, playerCount, pu.emulateCount, sampled * 1000, exact * 1000))
+
+def benchLookahead(count = 5, seed = 0):
+    random.seed(seed)
+    for street, size in (('flop', 3), ('turn', 4)):
+        build = lookup = 0.0
+        for idx in range(count):
+            pu = PokerUtils(seed = seed)
+            cards = random.sample(range(52), size + 2)
+            hold, ftr = tuple(cards[:2]), tuple(cards[2:])
+            start = time.time()
+            table = pu.lookahead(hold, ftr)
+            build += time.time() - start
+            nextCard = random.choice(table.keys())
+            start = time.time()
+            pu.loseRate(hold, ftr + (nextCard,))
+            pu.adaptiveHS(hold, ftr + (nextCard,), 2)
+            lookup += time.time() - start
+        record('lookahead.%s' % street, build / count)
+        print('lookahead %s: %d cards %.1fms, next street loseRate + HS %.3fms' %
+              (street, len(table), build / count * 1000, lookup / count * 1000))
+
+def benchPool(workers = multiprocessing.cpu_count(), count = 20000, seed = 0):
+    random.seed(seed)
+    hold, ftr = (12, 25), (29, 46, 1)
+    # fewer than 2 workers runs in this process, as 0 does
+    for size in [0] + ([workers] if workers > 1 else []):
+        pu = PokerUtils(size, seed)
+        pu.emulateCount = count
+        start = time.time()
+        pu.emulateHS(hold, ftr, 3)
+        print('HS x %d, %d workers: %.2fs' % (count, size,
+              record('pool.emulateHS.%d' % size, time.time() - start)))
+        pu.close()
+    # as decisions sample: adaptiveHS to emulateMax trials, new spots
+    spots = []
+    for idx in range(20):
+        cards = random.sample(range(52), 5)
+        spots.append((tuple(cards[:2]), tuple(cards[2:]), 3))
+    for size in [0] + ([workers] if workers > 1 else []):
+        pu = PokerUtils(size, seed)
+        pu.cache.maxEntries = 0
+        adaptive = record('pool.adaptiveHS.%d' % size,
+                          timeCalls(lambda spot: pu.adaptiveHS(*spot, precision = 0), spots))
+        print('adaptiveHS x %d, %d workers: %.1fms' % (pu.emulateMax, size, adaptive * 1000))
+        pu.close()
+
+def benchAdaptiveHS(count = 50, seed = 0):
+    random.seed(seed)
+    pu = PokerUtils(seed = seed)
+    spots = []
+    for idx in range(count):
+        cards = random.sample(range(52), random.choice([5, 6, 7]))
+        bet, pot = random.choice([(40, 100), (200, 300), (20, 400)])
+        thresholds = [rr * bet / float(bet + pot) for rr in (1.0, 1.5, 2.0, 4.0)]
+        spots.append((tuple(cards[:2]), tuple(cards[2:]), random.randint(1, 4), thresholds))
+    fixed = timeCalls(lambda spot: pu.emulateHS(*spot[:3]), spots)
+    samples = []
+    adaptive = record('adaptiveHS', timeCalls(lambda spot: samples.append(pu.adaptiveHS(*spot)[1]), spots))
+    print('HS: fixed %d trials %.1fms, adaptive %.0f trials avg %.1fms' %
+          (pu.emulateCount, fixed * 1000, sum(samples) * 1.0 / len(samples), adaptive * 1000))
+
+# Server traffic of hands hands between 8 players, as the protocol
+# lays it out (values are random, not a consistent game), ending with
+# game-over
+def sampleTraffic(hands = 100, seed = 0):
+    rng = random.Random(seed)
+    pids = [str(1111 * (idx + 1)) for idx in range(8)]
+    cardLine = lambda card: '%s %s \n' % (COLORS[card / 13], POINTS[card % 13])
+    def rows(tag, count):
+        text = '%s/ \n' % tag
+        for pid in rng.sample(pids, count):
+            text += '%s %d %d %d %s \n' % (pid, rng.randint(0, 2000), rng.randint(0, 8000),
+                rng.randint(0, 500), rng.choice(['check', 'call', 'raise', 'all_in', 'fold']))
+        return text + 'total pot: %d \n/%s \n' % (rng.randint(0, 4000), tag)
+    traffic = []
+    for hand in range(hands):
+        cards = rng.sample(range(52), 21)
+        text = 'seat/ \nbutton: %s 2000 8000 \nsmall blind: %s 2000 8000 \n' \
+               'big blind: %s 2000 8000 \n' % tuple(pids[:3])
+        text += ''.join('%s 2000 8000 \n' % pid for pid in pids[3:]) + '/seat \n'
+        text += 'blind/ \n%s: 20 \n%s: 40 \n/blind \n' % tuple(pids[1:3])
+        text += 'hold/ \n' + cardLine(cards[0]) + cardLine(cards[1]) + '/hold \n'
+        text += rows('inquire', 3) + rows('notify', 8)
+        for street, board in (('flop', cards[2:5]), ('turn', cards[5:6]), ('river', cards[6:7])):
+            text += '%s/ \n' % street + ''.join(cardLine(card) for card in board) + '/%s \n' % street
+            text += rows('inquire', 4) + rows('notify', 4)
+        text += 'showdown/ \ncommon/ \n' + ''.join(cardLine(card) for card in cards[2:7]) + '/common \n'
+        for rank, pid in enumerate(pids[:2]):
+            text += '%d: %s %s %s HIGH_CARD \n' % (rank + 1, pid, cardLine(cards[7 + 2 * rank]).strip(),
+                                                 cardLine(cards[8 + 2 * rank]).strip())
+        text += '/showdown \npot-win/ \n%s: %d \n/pot-win \n' % (pids[0], rng.randint(0, 4000))
+        traffic.append(text)
+    traffic.append('game-over \n')
+    return ''.join(traffic)
+
+# The framing PokerSocket did before MessageFramer: buffer strings until
+# the buffer ends with a closing line, then regex over all of it
+def legacyFrames(chunks):
+    closeList = ['/seat', '/blind', '/hold', '/flop', '/turn', '/river', '/showdown',
+                 '/pot-win', '/inquire', '/notify', 'game-over']
+    patt = r'((?P<TypeTag>[^/]+)/[\s\S]+?/(?P=TypeTag)|game-over)'
+    messages = 0
+    tempData = ''
+    for data in chunks:
+        msg = tempData + data
+        if msg.strip().split('\n')[-1].strip() not in closeList:
+            tempData = msg
+            continue
+        messages += len(re.findall(patt, msg))
+        tempData = ''
+    return messages
+
+# traffic: recorded server traffic, sampleTraffic(hands, seed) if None
+def benchFramer(hands = 200, seed = 0, traffic = None):
+    if traffic:
+        # whole, so every chunk size has to find the same messages
+        expected = len(MessageFramer().feed(traffic))
+    else:
+        traffic = sampleTraffic(hands, seed)
+        expected = len(re.findall(r'^(?:[a-z-]+/|game-over) $', traffic, re.M)) - hands   # common/
+    for size in (1, 1024, 65536):
+        chunks = [traffic[idx:idx + size] for idx in xrange(0, len(traffic), size)]
+        framer = MessageFramer()
+        start = time.time()
+        messages = sum(len(framer.feed(chunk)) for chunk in chunks)
+        framed = time.time() - start
+        assert messages == expected, (messages, expected)
+        record('framer.%d.perMB' % size, framed / len(traffic) * 1e6)
+        start = time.time()
+        legacy = legacyFrames(chunks)
+        print('%d KB in %d byte chunks: framer %.1f MB/s, legacy %.1f MB/s, '
+              'legacy got %d of %d messages' %
+              (len(traffic) / 1024, size, len(traffic) / framed / 1e6,
+               len(traffic) / (time.time() - start) / 1e6, legacy, messages))
+
+# Per message work of the handlers before parseMessage: a StringIO, the
+# lines read back out of it, every line split and its numbers converted
+def legacyParse(message):
+    buf = StringIO.StringIO(message)
+    tag = buf.readline().strip()
+    fields = []
+    for line in buf.readlines():
+        line = line.strip()
+        if line == '/' + tag[:-1]:
+            break
+        fields.append([int(field) if field.isdigit() else field
+                       for field in line.split(': ')[-1].split(' ')])
+    return tag, fields
+
+# traffic: as benchFramer
+def benchParser(hands = 300, traffic = None):
+    traffic = traffic or sampleTraffic(hands)
+    messages = [message for message in MessageFramer().feed(traffic)
+                if message.strip() != 'game-over']
+    for name, parse in (('legacy', legacyParse), ('parseMessage', parseMessage)):
+        start = time.time()
+        for message in messages:
+            parse(message)
+        seconds = record('parse.%s' % name, (time.time() - start) / len(messages))
+        print('%s: %.0f msgs/s' % (name, 1 / seconds))
+    # parse and apply to PokerState, no decisions
+    for name in ('msgHandler', 'handle'):
+        pm = PokerMessage(PokerState('0'), speculate = False)
+        pm.pa.replyHandler = lambda players: 'check'
+        apply = pm.msgHandler if name == 'msgHandler' else pm.handle
+        start = time.time()
+        for message in messages:
+            apply(message)
+        seconds = record('parse.%s' % name, (time.time() - start) / len(messages))
+        print('%s: %.0f msgs/s' % (name, 1 / seconds))
+        pm.pa.close()
+
+# HS as decisions call it, exact where it can be, no cache
+def benchHS(count = 10, seed = 0):
+    random.seed(seed)
+    pu = PokerUtils(seed = seed)
+    pu.cache.maxEntries = 0
+    for street, size in (('flop', 3), ('turn', 4), ('river', 5)):
+        times = []
+        for playerCount in (1, 2, 3):
+            spots = []
+            for idx in range(count):
+                cards = random.sample(range(52), size + 2)
+                spots.append((tuple(cards[:2]), tuple(cards[2:]), playerCount))
+            times.append(record('HS.%s.%d' % (street, playerCount),
+                                timeCalls(lambda spot: pu.HS(*spot), spots)))
+        print('HS %s x1/x2/x3: %s' % (street, ' / '.join('%.2fms' % (t * 1000) for t in times)))
+
+# holdRound and RRRound end to end: a seeded self-play match, time per
+# decision by round as PokerAlgorithm measured it
+def benchDecisions(seats = 6, hands = 200, seed = 0):
+    match = SelfPlay(seats, hands, seed).play()
+    used = collections.defaultdict(list)
+    for pm in match.bots.itervalues():
+        for decision in pm.pa.decisions:
+            used[decision['round']].append(decision['used'])
+    for street in ('hold', 'flop', 'turn', 'river'):
+        if used[street]:
+            mean = record('decision.%s' % street, sum(used[street]) / len(used[street]))
+            print('decision %s: %d, mean %.2fms, max %.2fms' %
+                  (street, len(used[street]), mean * 1000, max(used[street]) * 1000))
+    record('selfPlay.hand', match.elapsed / match.table.handCount)
+    print('self-play: %.1f hands/s' % (match.table.handCount / match.elapsed))
+
+BENCHES = collections.OrderedDict([
+    ('evaluator', benchEvaluator),
+    ('handState', benchHandState),
+    ('batch', benchBatch),
+    ('loseRate', benchLoseRate),
+    ('HS', benchHS),
+    ('adaptiveHS', benchAdaptiveHS),
+    ('exact', benchExact),
+    ('lookahead', benchLookahead),
+    ('pool', benchPool),
+    ('framer', benchFramer),
+    ('parser', benchParser),
+    ('decisions', benchDecisions)
+    ])
+# benches that need numpy
+NUMPY_BENCHES = ('batch', 'lookahead')
+# benches taking --traffic
+TRAFFIC_BENCHES = ('framer', 'parser')
+
+# Return: [(name, baseline, result)] of the results slower than the
+# baseline by more than threshold (0.2: 20%)
+def regressions(results, baseline, threshold):
+    slower = []
+    for name, seconds in results.iteritems():
+        if baseline.get(name) and seconds > baseline[name] * (1 + threshold):
+            slower.append((name, baseline[name], seconds))
+    return slower
+
+def main(argv):
+    parser = argparse.ArgumentParser(description = 'Benchmarks, fixed seeds')
+    parser.add_argument('benches', nargs = '*', metavar = 'bench',
+                        help = 'of %s, all if none' % ', '.join(BENCHES))
+    parser.add_argument('--json', help = 'write the results to this file')
+    parser.add_argument('--compare', metavar = 'BASELINE',
+                        help = 'results file of an earlier --json run')
+    parser.add_argument('--threshold', type = float, default = 0.25,
+                        help = 'slowdown flagged by --compare, 0.25 = 25%%')
+    parser.add_argument('--repeat', type = int, default = 3,
+                        help = 'runs of each bench, the best time is kept')
+    parser.add_argument('--traffic', metavar = 'FILE',
+                        help = 'recorded server traffic (the bytes a bot read, '
+                        'e.g. from a PokerServer match) for %s' % ', '.join(TRAFFIC_BENCHES))
+    args = parser.parse_args(argv)
+    traffic = None
+    if args.traffic:
+        with open(args.traffic, 'rb') as f:
+            traffic = f.read()
+    for name in args.benches or BENCHES:
+        if name not in BENCHES:
+            parser.error('unknown bench: %s' % name)
+        if np is None and name in NUMPY_BENCHES:
+            continue
+        for idx in range(max(1, args.repeat)):
+            if traffic and name in TRAFFIC_BENCHES:
+                BENCHES[name](traffic = traffic)
+            else:
+                BENCHES[name]()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'numpy': np.__version__ if np is not None else None,
+                'cpus': multiprocessing.cpu_count(),
+                'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'results': RESULTS
+                }, f, indent = 2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        slower = regressions(RESULTS, baseline, args.threshold)
+        for name, old, new in slower:
+            print('REGRESSION %s: %.3gs -> %.3gs (+%.0f%%)' %
+                  (name, old, new, (new / old - 1) * 100))
+        print('%d of %d compared results slower than baseline by more than %.0f%%' %
+              (len(slower), len(set(RESULTS) & set(baseline)), args.threshold * 100))
+        return 1 if slower else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
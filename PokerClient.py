@@ -0,0 +1,152 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+
+import multiprocessing, select, socket, sys, threading, time, traceback
+from PokerStats import OpponentStats
+from PokerTools import MessageFramer, PokerMessage, PokerState
+
+# One bot of a PokerClient: its own connection, PokerState, PokerMessage
+# and PokerAlgorithm. The connection is read and framed in the client's
+# process; the messages go down a pipe to the seat's own process, which
+# decides and sends the replies itself. A long decision, or the seat's
+# speculation, only holds up this seat.
+class PokerSeat:
+    # conn_args: see PokerSocket
+    # workers: equity process pool size of this seat, see PokerUtils
+    # statsFile: OpponentStats file this seat opens, None for none
+    def __init__(self, conn_args, workers = 0, speculate = True, statsFile = None):
+        self.pid = conn_args[2]
+        self.workers = workers
+        self.speculate = speculate
+        self.statsFile = statsFile
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(conn_args[1])
+        while True:
+            try:
+                self.sock.connect(conn_args[0])
+                break
+            except socket.error:
+                print('%s: connect timeout...' % self.pid)
+                time.sleep(1)
+        self.framer = MessageFramer()
+        # complete messages, None ends the seat's process
+        self.inbox, self.outbox = multiprocessing.Pipe(False)
+        # game-over framed
+        self.over = False
+        self.process = None
+
+    # others: sockets of the other seats, closed in this seat's process
+    # so a seat that is done really hangs up
+    def start(self, others = ()):
+        self.process = multiprocessing.Process(target = self.__run, args = (others,))
+        self.process.start()
+        self.sock.sendall('reg: %s %s need_notify \n' % (self.pid, 'ARE_YOU_OK'))
+
+    # data: bytes received on the connection, '' when it was closed
+    def feed(self, data):
+        if not data:
+            self.outbox.send(None)
+            return
+        for message in self.framer.feed(data):
+            self.outbox.send(message)
+            if message.strip() == 'game-over':
+                self.over = True
+
+    # Seat process from here on
+    def __send(self, data):
+        with self.sendLock:
+            try:
+                self.sock.sendall(data)
+            except socket.error:
+                print('%s: send failed' % self.pid)
+
+    def __run(self, others):
+        for sock in others:
+            sock.close()
+        stats = None
+        if self.statsFile is not None:
+            try:
+                stats = OpponentStats(self.statsFile)
+            except (OSError, ValueError) as e:
+                print('%s: no opponent stats: %s' % (self.pid, e))
+        pm = PokerMessage(PokerState(self.pid, stats), self.workers, self.speculate)
+        # replies come from this thread and from ReplyGuard timers
+        self.sendLock = threading.Lock()
+        pm.send = self.__send
+        over = False
+        while not over:
+            message = self.inbox.recv()
+            if message is None:
+                break
+            try:
+                reply = pm.handle(message)
+            except Exception:
+                print('%s: Oops!' % self.pid)
+                traceback.print_exc()
+                continue
+            if reply == 'game-over':
+                over = True
+            elif reply:
+                self.__send(reply)
+        if not over:
+            pm.pa.close()
+        if stats is not None:
+            stats.close()
+
+    def close(self):
+        if not self.over:
+            self.outbox.send(None)
+        self.process.join()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+
+# Hosts many seats behind one select loop, which does all the reads and
+# framing. Each seat decides in a process of its own, so seats never
+# wait on each other's equity work. Lookup and preflop tables are
+# memory-mapped files, the seats share their pages.
+class PokerClient:
+    # seats: [conn_args], see PokerSocket
+    # workers: equity process pool size of each seat
+    # statsFile: OpponentStats file of all seats, None for none. Each
+    #     seat opens it; the one that gets to write records the table's
+    #     opponents, the others only read
+    def __init__(self, seats, workers = 0, speculate = True, statsFile = None):
+        self.seats = [PokerSeat(conn_args, workers, speculate, statsFile)
+                      for conn_args in seats]
+        print('Connected %d seats' % len(self.seats))
+
+    def start(self):
+        bySock = dict((seat.sock, seat) for seat in self.seats)
+        for seat in self.seats:
+            seat.start([other.sock for other in self.seats if other is not seat])
+        while bySock:
+            readable, _, broken = select.select(bySock.keys(), [], bySock.keys(), 1.0)
+            for sock in set(readable + broken):
+                seat = bySock[sock]
+                try:
+                    data = sock.recv(65536)
+                except socket.error:
+                    data = ''
+                seat.feed(data)
+                if not data:
+                    print('%s: connection closed' % seat.pid)
+                    del bySock[sock]
+                elif seat.over:
+                    del bySock[sock]
+        for seat in self.seats:
+            seat.close()
+
+if __name__ == '__main__':
+    # python PokerClient.py server_ip server_port client_ip first_port first_pid seats [workers]
+    # seat i binds first_port + i and plays as first_pid + i, in a
+    # process of its own with a pool of workers if workers > 1
+    server = (sys.argv[1], int(sys.argv[2]))
+    port, pid, count = int(sys.argv[4]), int(sys.argv[5]), int(sys.argv[6])
+    PokerClient([(server, (sys.argv[3], port + idx), str(pid + idx))
+                 for idx in range(count)],
+                workers = int(sys.argv[7]) if len(sys.argv) > 7 else 0,
+                statsFile = OpponentStats.DEFAULT_FILE).start()
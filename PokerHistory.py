@@ -0,0 +1,284 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+
+import Queue, collections, math, mmap, os, struct, sys, threading
+from PokerTable import NUT_HANDS
+from PokerTools import (Actions, ActionRow, Blind, Cards, GameOver, PlayerRow,
+                        PotWin, Seat, Showdown, ShowdownRow)
+
+# A reply of ours and what it was made on, see PokerAlgorithm.decisions;
+# group, LR, HS, RR are None where the decision didn't get to them
+Decision = collections.namedtuple('Decision',
+    'hand round reply fallback used group LR HS RR')
+
+STREETS = ('hold', 'flop', 'turn', 'river')
+ACTIONS = ('blind', 'check', 'call', 'raise', 'all_in', 'fold')
+UNKNOWN = 255
+
+FILE_MAGIC = 'HANDHIST'
+FILE_VERSION = 1
+FILE_HEADER = struct.Struct('<8sI')     # magic, version
+RECORD_HEADER = struct.Struct('<BH')    # type, payload bytes
+
+# Record types. A pid is written once per file section as a PID record
+# and then referred to by its number.
+PID, SEAT, BLIND, CARDS, ACTIONS_, SHOWDOWN, POT_WIN, GAME_OVER, DECISION = range(9)
+
+PID_BODY = struct.Struct('<H')
+COUNT = struct.Struct('<B')
+SEAT_ROW = struct.Struct('<Hii')        # pid, jetton, money
+BET_ROW = struct.Struct('<Hi')          # pid, bet / win
+CARDS_BODY = struct.Struct('<BB')       # street, count
+ACTIONS_BODY = struct.Struct('<BiB')    # inquire 0 / notify 1, pot or -1, count
+ACTION_ROW = struct.Struct('<HiiiB')    # pid, jetton, money, bet, action
+SHOWDOWN_ROW = struct.Struct('<BHBBB')  # rank, pid, card, card, nut hand
+DECISION_BODY = struct.Struct('<IBBiBfbfff')
+# hand, street, action, raise num, fallback, used, group, LR, HS, RR;
+# None is NO_GROUP for group, NaN for the floats
+NO_GROUP = -128
+
+def _index(names, name):
+    try:
+        return names.index(name)
+    except ValueError:
+        return UNKNOWN
+
+def _name(names, index):
+    return names[index] if index < len(names) else None
+
+def _float(value):
+    return float('nan') if value is None else value
+
+def _value(value):
+    return None if math.isnan(value) else value
+
+# Appends every server message PokerMessage handled, and each decision,
+# to filepath as compact binary records. record() only queues: a
+# background thread encodes and writes whole batches, at each hand end
+# and every flushAt records. A file can hold any number of writers'
+# sections one after the other.
+class HistoryWriter:
+    def __init__(self, filepath, flushAt = 1000):
+        self.file = open(filepath, 'ab')
+        self.file.write(FILE_HEADER.pack(FILE_MAGIC, FILE_VERSION))
+        self.flushAt = flushAt
+        self.pending = []
+        # [record, ...] batches, None stops the thread
+        self.queue = Queue.Queue()
+        # pid => number, writer thread only
+        self.pids = {}
+        self.encoders = {
+            Seat: self.__seat,
+            Blind: self.__blind,
+            Cards: self.__cards,
+            Actions: self.__actions,
+            Showdown: self.__showdown,
+            PotWin: self.__potWin,
+            GameOver: lambda record, out, body: GAME_OVER,
+            Decision: self.__decision
+            }
+        self.thread = threading.Thread(target = self.__write)
+        self.thread.daemon = True
+        self.thread.start()
+
+    # record: a parseMessage record or a Decision
+    def record(self, record):
+        self.pending.append(record)
+        if type(record) in (PotWin, GameOver) or len(self.pending) >= self.flushAt:
+            self.flush()
+
+    # hand: PokerState.getHandCount(), decision: PokerAlgorithm.decisions[-1]
+    def decision(self, hand, decision):
+        inputs = decision['inputs']
+        self.record(Decision(hand, decision['round'], decision['reply'],
+                             decision['fallback'], decision['used'], inputs.get('group'),
+                             inputs.get('LR'), inputs.get('HS'), inputs.get('RR')))
+
+    def flush(self):
+        if self.pending:
+            self.queue.put(self.pending)
+            self.pending = []
+
+    def close(self):
+        if self.file is None:
+            return
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+        self.file = None
+
+    def __write(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                break
+            out = []
+            for record in batch:
+                body = []
+                kind = self.encoders[type(record)](record, out, body)
+                body = ''.join(body)
+                out.append(RECORD_HEADER.pack(kind, len(body)) + body)
+            self.file.write(''.join(out))
+            self.file.flush()
+
+    # Return: number of pid, its PID record goes to out the first time
+    def __pid(self, pid, out):
+        number = self.pids.get(pid)
+        if number is None:
+            number = self.pids[pid] = len(self.pids)
+            body = PID_BODY.pack(number) + pid
+            out.append(RECORD_HEADER.pack(PID, len(body)) + body)
+        return number
+
+    def __seat(self, seat, out, body):
+        body.append(COUNT.pack(len(seat.players)))
+        for row in seat.players:
+            body.append(SEAT_ROW.pack(self.__pid(row.pid, out), row.jetton, row.money))
+        return SEAT
+
+    def __blind(self, blind, out, body):
+        body.append(COUNT.pack(len(blind.bets)))
+        for pid, bet in blind.bets:
+            body.append(BET_ROW.pack(self.__pid(pid, out), bet))
+        return BLIND
+
+    def __cards(self, cards, out, body):
+        body.append(CARDS_BODY.pack(_index(STREETS, cards.street), len(cards.cards)))
+        body.append(struct.pack('<%dB' % len(cards.cards), *cards.cards))
+        return CARDS
+
+    def __actions(self, actions, out, body):
+        body.append(ACTIONS_BODY.pack(actions.kind == 'notify',
+                    -1 if actions.pot is None else actions.pot, len(actions.rows)))
+        for row in actions.rows:
+            body.append(ACTION_ROW.pack(self.__pid(row.pid, out), row.jetton, row.money,
+                                        row.bet, _index(ACTIONS, row.action)))
+        return ACTIONS_
+
+    def __showdown(self, showdown, out, body):
+        body.append(COUNT.pack(len(showdown.board)))
+        body.append(struct.pack('<%dB' % len(showdown.board), *showdown.board))
+        body.append(COUNT.pack(len(showdown.ranks)))
+        for row in showdown.ranks:
+            body.append(SHOWDOWN_ROW.pack(row.rank, self.__pid(row.pid, out),
+                        row.hold[0], row.hold[1], _index(NUT_HANDS, row.nut)))
+        return SHOWDOWN
+
+    def __potWin(self, potWin, out, body):
+        body.append(COUNT.pack(len(potWin.wins)))
+        for pid, num in potWin.wins:
+            body.append(BET_ROW.pack(self.__pid(pid, out), num))
+        return POT_WIN
+
+    def __decision(self, decision, out, body):
+        fields = decision.reply.split()
+        body.append(DECISION_BODY.pack(decision.hand, _index(STREETS, decision.round),
+            _index(ACTIONS, fields[0]), int(fields[1]) if len(fields) > 1 else 0,
+            decision.fallback, decision.used,
+            NO_GROUP if decision.group is None else decision.group,
+            _float(decision.LR), _float(decision.HS), _float(decision.RR)))
+        return DECISION
+
+# Yields the records of filepath in order: parseMessage records and
+# Decisions, as HistoryWriter got them. A record torn by a crash may be
+# followed by the next run's section; a record that runs into a
+# FILE_MAGIC, or past the end, or doesn't decode, is dropped along with
+# the rest of its section and reading goes on at the next FILE_MAGIC.
+def readHistory(filepath):
+    with open(filepath, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return
+        data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    try:
+        pos = 0
+        pids = []
+        while pos < size:
+            if data[pos:pos + len(FILE_MAGIC)] == FILE_MAGIC:
+                magic, version = FILE_HEADER.unpack_from(data, pos)
+                if version != FILE_VERSION:
+                    raise ValueError('Not a version %d hand history: %s' %
+                                     (FILE_VERSION, filepath))
+                pos += FILE_HEADER.size
+                pids = []
+                continue
+            start = pos
+            end = size + 1
+            if pos + RECORD_HEADER.size <= size:
+                kind, length = RECORD_HEADER.unpack_from(data, pos)
+                end = pos + RECORD_HEADER.size + length
+            resync = end > size or \
+                     data.find(FILE_MAGIC, start + 1, end + len(FILE_MAGIC) - 1) >= 0
+            record = None
+            if not resync:
+                body = data[end - length:end]
+                try:
+                    if kind == PID:
+                        pids.append(body[PID_BODY.size:])
+                    else:
+                        record = _decode(kind, body, pids)
+                except (struct.error, IndexError):
+                    resync = True
+            if resync:
+                pos = data.find(FILE_MAGIC, start + 1)
+                if pos < 0:
+                    break
+                continue
+            pos = end
+            if record is not None:
+                yield record
+    finally:
+        data.close()
+
+def _rows(row, body, offset, count):
+    return [row.unpack_from(body, offset + idx * row.size) for idx in range(count)]
+
+def _decode(kind, body, pids):
+    if kind == SEAT:
+        count = COUNT.unpack_from(body)[0]
+        return Seat(tuple(PlayerRow(pids[pid], jetton, money) for pid, jetton, money
+                          in _rows(SEAT_ROW, body, COUNT.size, count)))
+    if kind == BLIND:
+        count = COUNT.unpack_from(body)[0]
+        return Blind(tuple((pids[pid], bet) for pid, bet
+                           in _rows(BET_ROW, body, COUNT.size, count)))
+    if kind == CARDS:
+        street, count = CARDS_BODY.unpack_from(body)
+        return Cards(_name(STREETS, street), tuple(bytearray(body[CARDS_BODY.size:])))
+    if kind == ACTIONS_:
+        notify, pot, count = ACTIONS_BODY.unpack_from(body)
+        return Actions('notify' if notify else 'inquire',
+                       tuple(ActionRow(pids[pid], jetton, money, bet, _name(ACTIONS, action))
+                             for pid, jetton, money, bet, action
+                             in _rows(ACTION_ROW, body, ACTIONS_BODY.size, count)),
+                       None if pot < 0 else pot)
+    if kind == SHOWDOWN:
+        count = COUNT.unpack_from(body)[0]
+        board = tuple(bytearray(body[COUNT.size:COUNT.size + count]))
+        offset = COUNT.size + count
+        count = COUNT.unpack_from(body, offset)[0]
+        return Showdown(board, tuple(ShowdownRow(rank, pids[pid], (a, b), _name(NUT_HANDS, nut))
+                                     for rank, pid, a, b, nut
+                                     in _rows(SHOWDOWN_ROW, body, offset + COUNT.size, count)))
+    if kind == POT_WIN:
+        count = COUNT.unpack_from(body)[0]
+        return PotWin(tuple((pids[pid], num) for pid, num
+                            in _rows(BET_ROW, body, COUNT.size, count)))
+    if kind == GAME_OVER:
+        return GameOver()
+    if kind == DECISION:
+        hand, street, action, num, fallback, used, group, LR, HS, RR = \
+            DECISION_BODY.unpack_from(body)
+        reply = _name(ACTIONS, action)
+        if reply == 'raise':
+            reply += ' %d' % num
+        return Decision(hand, _name(STREETS, street), reply, bool(fallback), used,
+                        None if group == NO_GROUP else group, _value(LR), _value(HS), _value(RR))
+    # a record type from a later version
+    return None
+
+if __name__ == '__main__':
+    # python PokerHistory.py filepath: every record
+    for record in readHistory(sys.argv[1]):
+        print(record)
@@ -0,0 +1,159 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+
+import array, os, struct, sys, zlib
+from deuces import Card, Evaluator
+from PokerUtils import CARD_COLOR, CARD_POINT
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# All-in equity of the 169 starting hands against 1-7 random opponents,
+# generated offline (python PokerPreflop.py) into preflop.bin.
+#
+# A hand class is a cell of the 13x13 grid, row * 13 + col: pairs on the
+# diagonal, suited below it (row = higher rank), offsuit above.
+class PreflopTable:
+    MAX_OPPONENTS = 7
+    FILE_MAGIC = 'PREFLOP_'
+    FILE_VERSION = 1
+    FILE_HEADER = struct.Struct('<8sIIII')  # magic, version, classes, opponents, crc32
+    DEFAULT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'preflop.bin')
+
+    # card * 52 + card => class
+    CLASS_OF = [0] * (52 * 52)
+    for a in range(52):
+        for b in range(52):
+            hi, lo = max(a % 13, b % 13), min(a % 13, b % 13)
+            if hi == lo or a / 13 == b / 13:
+                CLASS_OF[a * 52 + b] = hi * 13 + lo
+            else:
+                CLASS_OF[a * 52 + b] = lo * 13 + hi
+    del a, b, hi, lo
+
+    _shared = None
+
+    # equities: array('H'), class * MAX_OPPONENTS + opponents - 1,
+    # equity * 65535
+    def __init__(self, equities):
+        self.equities = equities
+
+    # hold: (int<card>, int<card>)
+    @staticmethod
+    def holdClass(hold):
+        return PreflopTable.CLASS_OF[hold[0] * 52 + hold[1]]
+
+    # One hand of the class: (int<card>, int<card>)
+    @staticmethod
+    def classHold(cls):
+        hi, lo = max(cls / 13, cls % 13), min(cls / 13, cls % 13)
+        if hi == lo or cls / 13 < cls % 13:
+            return (hi, 13 + lo)    # pair or offsuit: spade and heart
+        return (hi, lo)             # suited: spades
+
+    # '87', 'A9s', 'TT' ... as PokerAlgorithm.holdGroup writes them
+    @staticmethod
+    def className(cls):
+        hold = PreflopTable.classHold(cls)
+        name = ''
+        for card in hold:
+            if CARD_POINT[card] >= 10:
+                name += ['T', 'J', 'Q', 'K', 'A'][CARD_POINT[card] - 10]
+            else:
+                name += str(CARD_POINT[card])
+        if CARD_COLOR[hold[0]] == CARD_COLOR[hold[1]]:
+            name += 's'
+        return name
+
+    # hold: (int<card>, int<card>)
+    # opponents: 1-7
+    # Return: float<equity 0-1>, ties shared
+    def equity(self, hold, opponents):
+        return self.classEquity(PreflopTable.CLASS_OF[hold[0] * 52 + hold[1]], opponents)
+
+    # equity() of any hand of class cls
+    def classEquity(self, cls, opponents):
+        opponents = min(max(opponents, 1), PreflopTable.MAX_OPPONENTS)
+        return self.equities[cls * PreflopTable.MAX_OPPONENTS + opponents - 1] / 65535.0
+
+    def save(self, filepath):
+        body = self.equities.tostring()
+        header = PreflopTable.FILE_HEADER.pack(PreflopTable.FILE_MAGIC,
+            PreflopTable.FILE_VERSION, 169, PreflopTable.MAX_OPPONENTS,
+            zlib.crc32(body) & 0xFFFFFFFF)
+        tmppath = '%s.%d.tmp' % (filepath, os.getpid())
+        with open(tmppath, 'wb') as f:
+            f.write(header + body)
+        os.rename(tmppath, filepath)
+
+    # Raises ValueError on a bad file, IOError if it can't be read
+    @staticmethod
+    def load(filepath):
+        with open(filepath, 'rb') as f:
+            data = f.read()
+        size = PreflopTable.FILE_HEADER.size
+        if len(data) < size:
+            raise ValueError('Preflop file too short: %s' % filepath)
+        magic, version, classes, opponents, crc = \
+            PreflopTable.FILE_HEADER.unpack_from(data, 0)
+        if magic != PreflopTable.FILE_MAGIC or \
+           version != PreflopTable.FILE_VERSION or \
+           classes != 169 or opponents != PreflopTable.MAX_OPPONENTS:
+            raise ValueError('Not a version %d preflop file: %s' %
+                             (PreflopTable.FILE_VERSION, filepath))
+        if zlib.crc32(data[size:]) & 0xFFFFFFFF != crc:
+            raise ValueError('Preflop file checksum mismatch: %s' % filepath)
+        equities = array.array('H')
+        equities.fromstring(data[size:])
+        return PreflopTable(equities)
+
+    # One table per process
+    @staticmethod
+    def shared(filepath = None):
+        if PreflopTable._shared is None:
+            PreflopTable._shared = PreflopTable.load(
+                filepath or PreflopTable.DEFAULT_FILE)
+        return PreflopTable._shared
+
+    # Monte Carlo over trials deals per class: a board and 7 opponent
+    # holds per deal, the first k opponents give the k-opponent equity.
+    # Needs numpy.
+    @staticmethod
+    def generate(trials = 200000, seed = 0, chunk = 25000):
+        rng = np.random.RandomState(seed)
+        evaluator = Evaluator('direct')
+        deuces = np.array(Card.INDEX_TO_INT, dtype = np.int64)
+        maxOpponents = PreflopTable.MAX_OPPONENTS
+        equities = array.array('H')
+        for cls in range(169):
+            hold = PreflopTable.classHold(cls)
+            rest = np.array([card for card in range(52) if card not in hold])
+            shares = np.zeros(maxOpponents)
+            done = 0
+            while done < trials:
+                n = min(chunk, trials - done)
+                order = np.argsort(rng.random_sample((n, len(rest))), axis = 1)
+                dealt = rest[order[:, :5 + 2 * maxOpponents]]
+                board = dealt[:, :5]
+                hero = evaluator.evaluate_batch(
+                    deuces[np.hstack([board, np.tile(hold, (n, 1))])])
+                opponents = np.stack([evaluator.evaluate_batch(
+                    deuces[np.hstack([board, dealt[:, 5 + 2 * i:7 + 2 * i]])])
+                    for i in range(maxOpponents)], axis = 1)
+                for k in range(1, maxOpponents + 1):
+                    best = opponents[:, :k].min(axis = 1)
+                    ties = (opponents[:, :k] == hero[:, None]).sum(axis = 1)
+                    share = np.where(hero < best, 1.0,
+                                     np.where(hero == best, 1.0 / (1 + ties), 0.0))
+                    shares[k - 1] += share.sum()
+                done += n
+            equities.extend(int(round(share / trials * 65535)) for share in shares)
+        return PreflopTable(equities)
+
+if __name__ == '__main__':
+    # python PokerPreflop.py [trials] [filepath]
+    trials = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    filepath = sys.argv[2] if len(sys.argv) > 2 else PreflopTable.DEFAULT_FILE
+    PreflopTable.generate(trials).save(filepath)
+    print('wrote %s' % filepath)
@@ -0,0 +1,104 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+
+import array, multiprocessing, random, sys, time
+from PokerTable import PokerTable
+from PokerTools import PokerMessage, PokerState
+from PokerTrace import percentiles
+
+# Bots playing a PokerTable match in this process, no sockets: the
+# table's messages go straight into each bot's PokerMessage.handle.
+# Bots don't speculate by default, there is no idle time between
+# messages here to fill, and their equity work has no deadline, so a
+# seeded match plays the same on any machine.
+class SelfPlay:
+    # seats: number of bots, pids '1'..'seats'
+    # hands, seed: see PokerTable, bots are seeded from seed too
+    def __init__(self, seats = 6, hands = 600, seed = None, speculate = False):
+        self.pids = [str(idx + 1) for idx in range(seats)]
+        self.table = PokerTable(self.pids, seed, maxHands = hands)
+        self.startChips = self.table.chips()
+        self.bots = {}
+        for idx, pid in enumerate(self.pids):
+            pm = PokerMessage(PokerState(pid), speculate = speculate)
+            pm.pa.useDeadline = False
+            if seed is not None:
+                pm.pa.pu.seed(seed * len(self.pids) + idx)
+            self.bots[pid] = pm
+        self.seed = seed
+        # pid => array('d') of seconds per decision
+        self.times = dict((pid, array.array('d')) for pid in self.pids)
+        self.elapsed = 0.0
+
+    def send(self, pid, message):
+        self.bots[pid].handle(message)
+
+    def ask(self, pid, message):
+        start = time.time()
+        reply = self.bots[pid].handle(message)
+        self.times[pid].append(time.time() - start)
+        return reply
+
+    def play(self):
+        if self.seed is not None:
+            # PokerAlgorithm draws from the random module
+            random.seed(self.seed)
+        start = time.time()
+        self.table.play(self.send, self.ask)
+        self.elapsed = time.time() - start
+        return self
+
+    # Return: {'hands', 'seconds', 'chips': {pid: net chips},
+    #          'times': {pid: array('d')}}, mergeable by merge()
+    def results(self):
+        return {
+            'hands': self.table.handCount,
+            'seconds': self.elapsed,
+            'chips': dict((pid, chips - self.startChips[pid])
+                          for pid, chips in self.table.chips().iteritems()),
+            'times': self.times
+            }
+
+# args: (seats, hands, seed)
+def _playMatch(args):
+    return SelfPlay(*args).play().results()
+
+def merge(results):
+    total = {'hands': 0, 'seconds': 0.0, 'chips': {}, 'times': {}}
+    for result in results:
+        total['hands'] += result['hands']
+        total['seconds'] += result['seconds']
+        for pid, chips in result['chips'].iteritems():
+            total['chips'][pid] = total['chips'].get(pid, 0) + chips
+            total['times'].setdefault(pid, array.array('d')).extend(result['times'][pid])
+    return total
+
+# matches matches of seats bots, seeds seed, seed + 1, ..., on processes
+# processes (1 plays them in this process)
+def selfPlay(matches = 1, seats = 6, hands = 600, seed = 0, processes = 1):
+    jobs = [(seats, hands, seed + idx) for idx in range(matches)]
+    start = time.time()
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        results = pool.map(_playMatch, jobs, 1)
+        pool.close()
+    else:
+        results = map(_playMatch, jobs)
+    total = merge(results)
+    total['wall'] = time.time() - start
+    return total
+
+def report(total):
+    print('%d hands in %.2fs, %.1f hands/s' %
+          (total['hands'], total['wall'], total['hands'] / total['wall']))
+    print('%-6s %10s %10s %8s %8s %8s %8s' %
+          ('pid', 'chips', 'decisions', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+    for pid in sorted(total['chips'], key = int):
+        print('%-6s %+10d %10d %8.2f %8.2f %8.2f %8.2f' %
+              ((pid, total['chips'][pid], len(total['times'][pid])) +
+               tuple(seconds * 1000 for seconds in percentiles(total['times'][pid]))))
+
+if __name__ == '__main__':
+    # python PokerSelfPlay.py [matches] [seats] [hands] [seed] [processes]
+    args = [int(arg) for arg in sys.argv[1:]]
+    report(selfPlay(*args))
@@ -0,0 +1,201 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+
+import random, select, socket, sys, time
+from PokerTable import PokerTable
+from PokerTrace import percentiles
+
+class ServerConn:
+    def __init__(self, sock):
+        self.sock = sock
+        self.pid = None
+        self.notify = False
+        # received bytes not yet read as a line
+        self.inbuf = ''
+        # messages waiting for flush()
+        self.outbuf = []
+        self.closed = False
+        # seconds from inquire sent to reply read
+        self.latencies = []
+        self.timeouts = 0
+        # replies that came after their inquire timed out
+        self.late = 0
+        # inquires that timed out and whose reply hasn't come yet; a bot
+        # answers each inquire once and in order, so the next that many
+        # lines are late whenever they come
+        self.owed = 0
+
+    # Return: the next line, None if none came within timeout seconds
+    def readLine(self, timeout):
+        deadline = time.time() + timeout
+        while '\n' not in self.inbuf:
+            left = deadline - time.time()
+            if self.closed or left <= 0:
+                return None
+            self.sock.settimeout(left)
+            try:
+                data = self.sock.recv(4096)
+            except socket.timeout:
+                return None
+            except socket.error:
+                data = ''
+            finally:
+                # only the recv is timed, flush() sends block
+                self.sock.settimeout(None)
+            if not data:
+                self.closed = True
+                return None
+            self.inbuf += data
+        line, self.inbuf = self.inbuf.split('\n', 1)
+        return line.strip()
+
+    # Reads whatever the bot already sent, without waiting
+    # Return: complete lines dropped, replies to inquires that timed out
+    def drain(self):
+        while not self.closed and select.select([self.sock], [], [], 0)[0]:
+            try:
+                data = self.sock.recv(4096)
+            except socket.error:
+                data = ''
+            if not data:
+                self.closed = True
+                break
+            self.inbuf += data
+        lines = self.inbuf.count('\n')
+        self.inbuf = self.inbuf.rsplit('\n', 1)[-1]
+        return lines
+
+# Local stand-in for the match server: waits for seats bots to register,
+# then plays a PokerTable match against them over TCP.
+#   timeout: seconds a bot has to answer an inquire, then it folds
+#   fragment: > 0 cuts everything sent into random pieces of 1 to
+#       fragment bytes, glued across message boundaries
+#   latency: seconds slept before each flush of a bot's messages
+# report() prints hands per second and each bot's reply latency.
+class PokerServer:
+    # addr: (string<ip>, int<port>) to listen on
+    # hands, seed: see PokerTable
+    def __init__(self, addr, seats, hands = 600, seed = None, timeout = 0.5,
+                 fragment = 0, latency = 0.0):
+        self.seats = seats
+        self.hands = hands
+        self.seed = seed
+        self.timeout = timeout
+        self.fragment = fragment
+        self.latency = latency
+        self.random = random.Random(seed)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(addr)
+        self.sock.listen(seats)
+        self.conns = {}
+        self.table = None
+        self.elapsed = 0.0
+
+    # 'reg: pid pname [need_notify]'
+    def accept(self):
+        while len(self.conns) < self.seats:
+            sock, addr = self.sock.accept()
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = ServerConn(sock)
+            fields = (conn.readLine(10.0) or '').split()
+            if len(fields) < 2 or fields[0] != 'reg:':
+                print('Bad registration from %s:%d' % addr)
+                sock.close()
+                continue
+            conn.pid = fields[1]
+            conn.notify = 'need_notify' in fields
+            self.conns[conn.pid] = conn
+            print('%s registered' % conn.pid)
+
+    def send(self, pid, message):
+        self.conns[pid].outbuf.append(message)
+
+    def flush(self, conn):
+        if not conn.outbuf or conn.closed:
+            conn.outbuf = []
+            return
+        data = ''.join(conn.outbuf)
+        conn.outbuf = []
+        if self.latency:
+            time.sleep(self.latency)
+        pieces = [data]
+        if self.fragment > 0:
+            pieces = []
+            while data:
+                size = self.random.randint(1, self.fragment)
+                pieces.append(data[:size])
+                data = data[size:]
+        try:
+            for piece in pieces:
+                conn.sock.sendall(piece)
+        except socket.error:
+            conn.closed = True
+
+    def ask(self, pid, message):
+        conn = self.conns[pid]
+        # everyone sees what happened before this inquire
+        for other in self.conns.itervalues():
+            self.flush(other)
+        # answers to inquires that already timed out, in the socket or
+        # already read
+        late = conn.drain()
+        conn.late += late
+        conn.owed = max(0, conn.owed - late)
+        conn.outbuf.append(message)
+        self.flush(conn)
+        start = time.time()
+        while True:
+            reply = conn.readLine(start + self.timeout - time.time())
+            if reply is None or not conn.owed:
+                break
+            conn.owed -= 1
+            conn.late += 1
+        if reply is None:
+            conn.timeouts += 1
+            conn.owed += 1
+        else:
+            conn.latencies.append(time.time() - start)
+        return reply
+
+    def start(self):
+        self.accept()
+        pids = sorted(self.conns)
+        self.table = PokerTable(pids, self.seed, maxHands = self.hands,
+                                notify = [pid for pid in pids if self.conns[pid].notify])
+        start = time.time()
+        while self.table.playHand(self.send, self.ask):
+            for conn in self.conns.itervalues():
+                self.flush(conn)
+        self.table.gameOver(self.send)
+        for conn in self.conns.itervalues():
+            self.flush(conn)
+        self.elapsed = time.time() - start
+        for conn in self.conns.itervalues():
+            conn.sock.close()
+        self.sock.close()
+
+    def report(self):
+        print('%d hands in %.2fs, %.1f hands/s' %
+              (self.table.handCount, self.elapsed, self.table.handCount / self.elapsed))
+        chips = self.table.chips()
+        print('%-8s %8s %8s %8s %8s %8s %8s %8s %8s' % ('pid', 'replies', 'p50 ms',
+              'p90 ms', 'p99 ms', 'max ms', 'timeouts', 'late', 'chips'))
+        for pid in sorted(self.conns):
+            conn = self.conns[pid]
+            print('%-8s %8d %8.1f %8.1f %8.1f %8.1f %8d %8d %8d' %
+                  ((pid, len(conn.latencies)) +
+                   tuple(seconds * 1000 for seconds in percentiles(conn.latencies)) +
+                   (conn.timeouts, conn.late, chips[pid])))
+
+if __name__ == '__main__':
+    # python PokerServer.py ip port seats [hands] [seed] [timeout] [fragment] [latency]
+    args = sys.argv[1:] + [None] * 8
+    server = PokerServer((args[0], int(args[1])), int(args[2]),
+                         hands = int(args[3] or 600),
+                         seed = int(args[4]) if args[4] else None,
+                         timeout = float(args[5] or 0.5),
+                         fragment = int(args[6] or 0),
+                         latency = float(args[7] or 0.0))
+    server.start()
+    server.report()
@@ -6,8 +6,17 @@ from PokerTools import *
 
 class PokerSocket:
     # conn_args: ((string<ip>, int<port>), (string<ip>, int<port>), string<pid>)
-    def __init__(self, conn_args, timeout = 5, sock = None):
+    # workers: equity process pool size, 0 or 1 computes in this process
+    # tracer: PokerTrace.Tracer, see PokerMessage
+    # stats: PokerStats.OpponentStats, see PokerState
+    # history: PokerHistory.HistoryWriter, see PokerMessage
+    def __init__(self, conn_args, timeout = 5, sock = None, workers = 0, tracer = None,
+                 stats = None, history = None):
         self.timeout = timeout
+        self.workers = workers
+        self.tracer = tracer
+        self.stats = stats
+        self.history = history
         self.pid = conn_args[2]
         if sock is None:
             self.sock = socket.socket(
@@ -27,26 +36,36 @@ class PokerSocket:
             
     def start(self):
         self.sock.sendall('reg: %s %s need_notify \n' % (self.pid, 'ARE_YOU_OK'))
-        ps = PokerState(self.pid)
-        pm = PokerMessage(ps)
-        tempData = ''
-        while True:
+        ps = PokerState(self.pid, self.stats)
+        pm = PokerMessage(ps, self.workers, tracer = self.tracer, history = self.history)
+        pm.send = self.sock.sendall
+        framer = MessageFramer()
+        over = False
+        while not over:
             try:
-                data = self.sock.recv(1024)
-                if data:
-                    reply = pm.msgHandler(tempData + data)
+                data = self.sock.recv(65536)
+                if not data:
+                    print('Connection closed')
+                    self.sock.close()
+                    break
+                received = time.time()
+                messages = framer.feed(data)
+                if self.tracer is not None:
+                    self.tracer.received(received, time.time() - received)
+                for message in messages:
+                    reply = pm.handle(message)
                     if reply == 'game-over':
-                        self.sock.shutdown(socket.SHUT_RDWR)
-                        self.sock.close()
+                        over = True
                         break
-                    elif reply == 'waiting':
-                        tempData += data
                     elif reply:
                         #pprint.pprint(ps.state)
-                        tempData = ''
+                        start = time.time()
                         self.sock.sendall(reply)
-                    else:
-                        tempData = ''
+                        if self.tracer is not None:
+                            self.tracer.sent(start)
+                if over:
+                    self.sock.shutdown(socket.SHUT_RDWR)
+                    self.sock.close()
             
             except:
                 print('Oops!')
@@ -54,4 +73,3 @@ class PokerSocket:
                 self.sock.close()
                 break
             
-
@@ -0,0 +1,204 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+
+import Queue, fcntl, mmap, os, struct, sys, threading
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Opponent counters kept across matches in one append-only file: a
+# header, then records of (pid, counter deltas) appended at hand ends.
+# Appends are single O_APPEND writes under flock, so several bot
+# processes can share a file. Loading mmaps it and sums the records per
+# pid (columnwise with numpy), rewriting them summed once the file has
+# grown to COMPACT_RATIO records per pid.
+#
+# Bots of ours at one table all see the same opponents, so only one
+# process records: the first to open the file holds flock on
+# <file>.lock until close() and is the writer, add() does nothing in the
+# others. Every process lists its own pids in the lock file (ours()),
+# and the writer never records those as opponents. Matches played at
+# the same time on one host that share a file are therefore recorded
+# by the writer's match only.
+class OpponentStats:
+    FILE_MAGIC = 'OPPSTATS'
+    FILE_VERSION = 1
+    FILE_HEADER = struct.Struct('<8sII')    # magic, version, record size
+    FIELDS = ('hands', 'active', 'activeCount', 'showdownCount', 'winCount')
+    RECORD = struct.Struct('<16s5q')        # pid, FIELDS
+    COMPACT_RATIO = 8
+    DEFAULT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'opponents.bin')
+
+    # Raises ValueError on a bad file, OSError if it can't be opened
+    def __init__(self, filepath = None):
+        self.filepath = filepath or OpponentStats.DEFAULT_FILE
+        self.fd = os.open(self.filepath, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0644)
+        try:
+            self.lockfd = os.open(self.filepath + '.lock',
+                                  os.O_RDWR | os.O_CREAT | os.O_APPEND, 0644)
+        except:
+            os.close(self.fd)
+            raise
+        # records this match, see above
+        self.writer = False
+        # our pids as of the lock file's size
+        self.ourPids = set()
+        self.oursSize = 0
+        try:
+            # pid => (FIELDS), what earlier matches left in the file
+            self.history = self.__load()
+        except:
+            os.close(self.fd)
+            os.close(self.lockfd)
+            raise
+        # [{pid: (FIELDS)}, ...] for the writer thread, None stops it
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target = self.__write)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __load(self):
+        header = OpponentStats.FILE_HEADER
+        record = OpponentStats.RECORD
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            # elected under the file's lock, so nobody lists pids between
+            # the writer taking the lock file and clearing older matches'
+            try:
+                fcntl.flock(self.lockfd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self.writer = True
+                os.ftruncate(self.lockfd, 0)
+            except IOError:
+                pass
+            size = os.fstat(self.fd).st_size
+            if size == 0:
+                os.write(self.fd, header.pack(OpponentStats.FILE_MAGIC,
+                                              OpponentStats.FILE_VERSION, record.size))
+                return {}
+            data = mmap.mmap(self.fd, size, access = mmap.ACCESS_READ)
+            try:
+                if size < header.size or \
+                   header.unpack_from(data, 0) != (OpponentStats.FILE_MAGIC,
+                                                   OpponentStats.FILE_VERSION, record.size):
+                    raise ValueError('Not a version %d opponent stats file: %s' %
+                                     (OpponentStats.FILE_VERSION, self.filepath))
+                count = (size - header.size) / record.size
+                history = self.__sum(data, count)
+            finally:
+                data.close()
+            if count > OpponentStats.COMPACT_RATIO * max(len(history), 16):
+                self.__rewrite(history)
+            elif header.size + count * record.size < size:
+                # a record cut short by a crash, later appends must line up
+                os.ftruncate(self.fd, header.size + count * record.size)
+            return history
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    # Return: {pid: (FIELDS)} summed over the count records in data
+    def __sum(self, data, count):
+        offset = OpponentStats.FILE_HEADER.size
+        if np is not None:
+            dtype = np.dtype([('pid', 'S16')] + [(name, '<i8') for name in OpponentStats.FIELDS])
+            columns = np.frombuffer(data, dtype = dtype, count = count, offset = offset)
+            pids, inverse = np.unique(columns['pid'], return_inverse = True)
+            sums = [np.bincount(inverse, weights = columns[name], minlength = len(pids))
+                    for name in OpponentStats.FIELDS]
+            del columns
+            return dict((pid, tuple(int(column[idx]) for column in sums))
+                        for idx, pid in enumerate(pids))
+        history = {}
+        record = OpponentStats.RECORD
+        for idx in xrange(count):
+            values = record.unpack_from(data, offset + idx * record.size)
+            pid = values[0].rstrip('\0')
+            total = history.get(pid)
+            history[pid] = values[1:] if total is None else \
+                tuple(a + b for a, b in zip(total, values[1:]))
+        return history
+
+    # Called with the file locked
+    def __rewrite(self, history):
+        os.ftruncate(self.fd, OpponentStats.FILE_HEADER.size)
+        os.write(self.fd, self.__pack(history))
+
+    def __pack(self, counters):
+        return ''.join(OpponentStats.RECORD.pack(pid, *values)
+                       for pid, values in counters.iteritems())
+
+    def __write(self):
+        while True:
+            deltas = [self.queue.get()]
+            while not self.queue.empty():
+                deltas.append(self.queue.get())
+            # a pid in several batches gets several records, load sums them
+            ourPids = self.ourPidSet()
+            data = ''.join(self.__pack(dict((pid, values) for pid, values in batch.iteritems()
+                                            if pid not in ourPids))
+                           for batch in deltas if batch)
+            if data:
+                fcntl.flock(self.fd, fcntl.LOCK_EX)
+                try:
+                    os.write(self.fd, data)
+                except OSError:
+                    print('opponent stats: write failed')
+                finally:
+                    fcntl.flock(self.fd, fcntl.LOCK_UN)
+            if None in deltas:
+                break
+
+    # Return: (FIELDS) of pid from earlier matches, None if never met
+    def get(self, pid):
+        return self.history.get(pid)
+
+    # pid plays for us in this match, no process records it
+    def ours(self, pid):
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            os.write(self.lockfd, pid + '\n')
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    # Return: set of the pids listed by ours() in any process; reads the
+    # lock file when it grew, so only the writer thread asks
+    def ourPidSet(self):
+        size = os.fstat(self.lockfd).st_size
+        if size != self.oursSize:
+            os.lseek(self.lockfd, 0, os.SEEK_SET)
+            data = ''
+            while len(data) < size:
+                chunk = os.read(self.lockfd, size - len(data))
+                if not chunk:
+                    break
+                data += chunk
+            self.ourPids = set(data.split())
+            self.oursSize = size
+        return self.ourPids
+
+    # deltas: {pid: (FIELDS)} counted since the last add; written by a
+    # background thread, add never waits on the disk. Dropped unless
+    # this is the writer; the thread drops our pids.
+    def add(self, deltas):
+        if self.writer and deltas:
+            self.queue.put(deltas)
+
+    # Writes what was added, then closes the file
+    def close(self):
+        if self.fd is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        os.close(self.fd)
+        os.close(self.lockfd)
+        self.fd = None
+
+if __name__ == '__main__':
+    # python PokerStats.py [filepath]: the counters of every opponent
+    stats = OpponentStats(sys.argv[1] if len(sys.argv) > 1 else None)
+    print('%-16s %8s %8s %8s %8s' % ('pid', 'hands', 'active', 'showdown', 'win'))
+    for pid, (hands, active, activeCount, showdownCount, winCount) in \
+            sorted(stats.history.iteritems()):
+        print('%-16s %8d %8.2f %8d %8d' % (pid, hands,
+              active * 1.0 / activeCount if activeCount else 0.0, showdownCount, winCount))
+    stats.close()
@@ -0,0 +1,226 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+
+import random
+from deuces import Evaluator
+from PokerUtils import COLORS, POINTS
+
+# showdown nut_hand of a deuces rank class
+NUT_HANDS = [None, 'STRAIGHT_FLUSH', 'FOUR_OF_A_KIND', 'FULL_HOUSE', 'FLUSH',
+             'STRAIGHT', 'THREE_OF_A_KIND', 'TWO_PAIR', 'ONE_PAIR', 'HIGH_CARD']
+
+# card: int<card>, Return: 'color point' as the server writes it
+def cardLine(card):
+    return '%s %s' % (COLORS[card / 13], POINTS[card % 13])
+
+class TablePlayer:
+    def __init__(self, pid, jetton, money):
+        self.pid = pid
+        self.jetton = jetton
+        self.money = money
+        # this hand: cards, chips put in, last action
+        self.hold = ()
+        self.bet = 0
+        self.action = None
+        self.folded = False
+
+    # can still act this hand
+    def live(self):
+        return not self.folded and self.jetton > 0
+
+# The dealer of one match: seats, blinds, deals, betting and pots, with
+# every message written the way the match server writes it. Players
+# are reached through two callbacks, so the same table runs behind
+# sockets (PokerServer) or plain calls:
+#   send(pid, message): deliver a message that needs no reply
+#   ask(pid, message): deliver an inquire, Return: the reply line, or
+#       None if there was none in time
+# Replies: check, call, all_in, fold, or raise num, which calls and then
+# puts num more in (at least a big blind). A reply that can't be played
+# is taken as check when there is nothing to call, fold otherwise.
+class PokerTable:
+    # pids: in seat order
+    # notify: pids that get notify/ messages, all if None
+    def __init__(self, pids, seed = None, jetton = 2000, money = 8000,
+                 smallBlind = 20, maxHands = 600, notify = None):
+        self.players = [TablePlayer(pid, jetton, money) for pid in pids]
+        self.notify = set(pids if notify is None else notify)
+        self.random = random.Random(seed)
+        self.evaluator = Evaluator('direct')
+        self.buyIn = jetton
+        self.smallBlind = smallBlind
+        self.maxHands = maxHands
+        self.handCount = 0
+        self.button = -1
+
+    # Return: {pid: jetton + money}
+    def chips(self):
+        return dict((p.pid, p.jetton + p.money) for p in self.players)
+
+    # Plays hands until one player is left or maxHands, then game-over
+    def play(self, send, ask):
+        while self.playHand(send, ask):
+            pass
+        self.gameOver(send)
+
+    def gameOver(self, send):
+        for p in self.players:
+            send(p.pid, 'game-over \n')
+
+    # Return: False if no hand could be played
+    def playHand(self, send, ask):
+        for p in self.players:
+            if p.jetton == 0 and p.money > 0:
+                p.jetton = min(self.buyIn, p.money)
+                p.money -= p.jetton
+            p.hold, p.bet, p.action, p.folded = (), 0, None, False
+        if self.handCount >= self.maxHands or \
+           sum(p.jetton > 0 for p in self.players) < 2:
+            return False
+        self.handCount += 1
+        # button moves to the next player with chips
+        count = len(self.players)
+        self.button = (self.button + 1) % count
+        while self.players[self.button].jetton == 0:
+            self.button = (self.button + 1) % count
+        seat = [p for p in self.players[self.button:] + self.players[:self.button]
+                if p.jetton > 0]
+        # most recent first, rows of inquire/ and notify/
+        self.acted = []
+
+        labels = ['button: ', 'small blind: ', 'big blind: ']
+        text = 'seat/ \n'
+        for idx, p in enumerate(seat):
+            text += '%s%s %d %d \n' % (labels[idx] if idx < 3 else '', p.pid, p.jetton, p.money)
+        text += '/seat \n'
+        self.__broadcast(send, seat, text)
+
+        # heads up the button posts the big blind
+        big = 2 if len(seat) > 2 else 0
+        text = 'blind/ \n'
+        for p, amount in ((seat[1], self.smallBlind), (seat[big], 2 * self.smallBlind)):
+            self.__put(p, amount)
+            p.action = 'blind'
+            self.acted.insert(0, p)
+            text += '%s: %d \n' % (p.pid, p.bet)
+        text += '/blind \n'
+        self.__broadcast(send, seat, text)
+
+        cards = self.random.sample(range(52), 5 + 2 * len(seat))
+        board = cards[:5]
+        for idx, p in enumerate(seat):
+            p.hold = tuple(cards[5 + 2 * idx:7 + 2 * idx])
+            send(p.pid, 'hold/ \n%s \n%s \n/hold \n' % (cardLine(p.hold[0]), cardLine(p.hold[1])))
+        self.__bettingRound(send, ask, seat, (big + 1) % len(seat))
+
+        for street, shown in (('flop', board[:3]), ('turn', board[3:4]), ('river', board[4:])):
+            if sum(not p.folded for p in seat) < 2:
+                break
+            self.__broadcast(send, seat, '%s/ \n%s/%s \n' %
+                             (street, ''.join(cardLine(card) + ' \n' for card in shown), street))
+            self.__bettingRound(send, ask, seat, 1 % len(seat))
+
+        self.__settle(send, seat, board)
+        return True
+
+    def __broadcast(self, send, seat, text):
+        for p in seat:
+            send(p.pid, text)
+
+    def __put(self, p, amount):
+        amount = min(amount, p.jetton)
+        p.jetton -= amount
+        p.bet += amount
+
+    def __actions(self, tag, seat):
+        text = '%s/ \n' % tag
+        for p in self.acted:
+            text += '%s %d %d %d %s \n' % (p.pid, p.jetton, p.money, p.bet, p.action)
+        return text + 'total pot: %d \n/%s \n' % (sum(p.bet for p in seat), tag)
+
+    # first: index in seat of the first player to act
+    def __bettingRound(self, send, ask, seat, first):
+        order = seat[first:] + seat[:first]
+        maxBet = max(p.bet for p in seat)
+        pending = [p for p in order if p.live()]
+        while pending and sum(not p.folded for p in seat) > 1:
+            p = pending.pop(0)
+            if not p.live():
+                continue
+            # nobody left to bet against
+            if p.bet == maxBet and not any(q.live() for q in seat if q is not p):
+                continue
+            self.__apply(p, ask(p.pid, self.__actions('inquire', seat)), maxBet)
+            if p in self.acted:
+                self.acted.remove(p)
+            self.acted.insert(0, p)
+            if p.bet > maxBet:
+                maxBet = p.bet
+                idx = order.index(p)
+                pending = [q for q in order[idx + 1:] + order[:idx] if q.live()]
+            text = self.__actions('notify', seat)
+            for q in seat:
+                if q is not p and q.pid in self.notify:
+                    send(q.pid, text)
+
+    def __apply(self, p, reply, maxBet):
+        fields = (reply or '').split()
+        action = fields[0] if fields else None
+        toCall = maxBet - p.bet
+        if action == 'raise':
+            try:
+                raiseBy = max(int(fields[1]), 2 * self.smallBlind)
+            except (IndexError, ValueError):
+                action = None
+        if action == 'check' and toCall > 0 or \
+           action not in ('check', 'call', 'raise', 'all_in', 'fold'):
+            action = 'check' if toCall == 0 else 'fold'
+        if action == 'call' and toCall == 0:
+            action = 'check'
+        if action == 'fold':
+            p.folded = True
+        elif action == 'call':
+            self.__put(p, toCall)
+        elif action == 'raise':
+            self.__put(p, toCall + raiseBy)
+        elif action == 'all_in':
+            self.__put(p, p.jetton)
+        if p.jetton == 0 and not p.folded:
+            action = 'all_in'
+        p.action = action
+
+    # Showdown when two or more are left, then pot-win; pots split by
+    # how much each player put in, odd chips to the first in seat order
+    def __settle(self, send, seat, board):
+        contenders = [p for p in seat if not p.folded]
+        ranks = {}
+        if len(contenders) > 1:
+            for p in contenders:
+                ranks[p] = self.evaluator.evaluate_index(board + list(p.hold))
+            order = sorted(set(ranks.values()))
+            text = 'showdown/ \ncommon/ \n%s/common \n' % \
+                ''.join(cardLine(card) + ' \n' for card in board)
+            for p in sorted(contenders, key = lambda p: ranks[p]):
+                text += '%d: %s %s %s %s \n' % (order.index(ranks[p]) + 1, p.pid,
+                    cardLine(p.hold[0]), cardLine(p.hold[1]),
+                    NUT_HANDS[self.evaluator.get_rank_class(ranks[p])])
+            self.__broadcast(send, seat, text + '/showdown \n')
+
+        wins = {}
+        levels = sorted(set(p.bet for p in contenders))
+        levels[-1] = max(p.bet for p in seat)
+        last = 0
+        for level in levels:
+            pot = sum(min(p.bet, level) - min(p.bet, last) for p in seat)
+            last = level
+            eligible = [p for p in contenders if p.bet >= level] or contenders
+            best = min(ranks.get(p, 0) for p in eligible)
+            winners = [p for p in eligible if ranks.get(p, 0) == best]
+            for idx, p in enumerate(winners):
+                wins[p] = wins.get(p, 0) + pot / len(winners) + (idx < pot % len(winners))
+        text = 'pot-win/ \n'
+        for p in seat:
+            if wins.get(p):
+                p.jetton += wins[p]
+                text += '%s: %d \n' % (p.pid, wins[p])
+        self.__broadcast(send, seat, text + '/pot-win \n')
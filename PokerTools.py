@@ -1,17 +1,39 @@
 #!/usr/bin/python
 # -*- encoding: utf-8 -*-
 
-import StringIO, random, re
+import collections, random, re, threading, time
 from PokerAlgorithm import PokerAlgorithm
+from PokerUtils import CARD_OF, CARD_BIT
+from PokerStats import OpponentStats
+
+# One player of PokerState
+class PlayerRecord(object):
+    __slots__ = ('pid', 'jetton', 'money', 'hands', 'active', 'activeCount',
+                 'showdownCount', 'winCount')
+
+    def __init__(self, pid, jetton, money):
+        self.pid = pid
+        self.jetton = jetton
+        self.money = money
+        # hands seated in
+        self.hands = 0
+        self.active = 0
+        self.activeCount = 0
+        self.showdownCount = 0
+        self.winCount = 0
+
+    def toDict(self):
+        return dict((name, getattr(self, name)) for name in PlayerRecord.__slots__)
 
 class PokerState:
-    ''' State example
+    ''' State example, as get() returns it
     {
         'players': [
             {
                 'pid': string<>,
                 'jetton': int<>,
                 'money': int<>,
+                'hands': int<>,
                 'active': int<>,
                 'activeCount': int<>,
                 'showdownCount': int<>,
@@ -19,80 +41,159 @@ class PokerState:
             },
             ...
         ],
-        'hold': [(string<color>, int<point>), ...],
-        'ftr': [(string<color>, int<point>), ...],
+        'hold': (int<card>, ...),
+        'ftr': (int<card>, ...),
+        'cardsMask': int<mask of hold and ftr>,
         'button': string<>,
         'mypid': string<>,
         'blind': int<>,
         'pot': int<>,
         'round': string<seat/blind/hold/flop/turn/river/showdown>,
         'handCount': int<>,
-        'onlines': int<>
+        'onlines': [string<pid>, ...]
     }
+    Players are PlayerRecords found through a pid => index dict.
     '''
-    def __init__(self, mypid):
+    # stats: OpponentStats, the rates below count earlier matches too
+    # and saveStats() adds this match to it; None for this match only
+    # Several seats of ours at one table share stats with recording
+    # True for one of them, or each opponent is counted once per seat.
+    def __init__(self, mypid, stats = None):
         self.state = {
-            'players': [],
-            'hold': [],
-            'ftr': [], # flop & turn & river
+            'hold': (),
+            'ftr': (), # flop & turn & river
+            'cardsMask': 0,
             'button': None,
             'mypid': mypid,
             'blind': None, # small blind
             'pot': None,
             'round': None,
-            'handCount': 0,
-            'onlines': 0
+            'handCount': 0
             }
+        self.players = []
+        # pid => index in players
+        self.index = {}
+        # seated this hand, in seat order, without us
+        self.onlines = []
+        self.onlineSet = set()
+        self.stats = stats
+        if stats is not None:
+            stats.ours(mypid)
+        self.recording = True
+        # pid => counters as of the last saveStats()
+        self.saved = {}
 
     def cleanState(self):
-        self.state['hold'] = []
-        self.state['ftr'] = []
+        self.state['hold'] = ()
+        self.state['ftr'] = ()
+        self.state['cardsMask'] = 0
         self.state['button'] = None
         self.state['blind'] = None
         self.state['pot'] = None
         self.state['round'] = None
         
+    # card: int<card>, see PokerUtils.CARD_OF
     def addCard(self, card_type, card):
-        self.state[card_type].append(card)
+        self.state[card_type] += (card,)
+        self.state['cardsMask'] |= CARD_BIT[card]
         
+    # Return: a copy of the state of plain dicts and lists, see above
     def get(self):
-        return self.state
+        state = dict(self.state)
+        state['players'] = [player.toDict() for player in self.players]
+        state['onlines'] = list(self.onlines)
+        return state
+
+    # state: as get() returns it
+    @staticmethod
+    def fromDict(state):
+        ps = PokerState(state['mypid'])
+        for key in ps.state:
+            ps.state[key] = state[key]
+        ps.state['hold'] = tuple(state['hold'])
+        ps.state['ftr'] = tuple(state['ftr'])
+        for values in state['players']:
+            player = PlayerRecord(values['pid'], values['jetton'], values['money'])
+            for name in PlayerRecord.__slots__:
+                setattr(player, name, values[name])
+            ps.index[player.pid] = len(ps.players)
+            ps.players.append(player)
+        for pid in state['onlines']:
+            ps.onlines.append(pid)
+            ps.onlineSet.add(pid)
+        return ps
     
+    # Return: PlayerRecord, None if pid never sat
     def findPlayer(self, pid):
-        for i, v in enumerate(self.state['players']):
-            if v['pid'] == pid:
-                return self.state['players'][i]
-        return None
+        idx = self.index.get(pid)
+        if idx is None:
+            return None
+        return self.players[idx]
             
     # info: (pid, jetton, money)
     def addPlayer(self, info):
-        if info[0] != self.state['mypid']:
-            self.state['onlines'].append(info[0])
-        player = self.findPlayer(info[0])
+        pid = info[0]
+        if pid != self.state['mypid']:
+            self.onlines.append(pid)
+            self.onlineSet.add(pid)
+        player = self.findPlayer(pid)
         if player is None:
-            newPlayer = {
-                'pid': info[0],
-                'jetton': int(info[1]),
-                'money': int(info[2]),
-                'active': 0,
-                'activeCount': 0,
-                'showdownCount': 0,
-                'winCount': 0
-                }
-            self.state['players'].append(newPlayer)
+            player = PlayerRecord(pid, int(info[1]), int(info[2]))
+            self.index[pid] = len(self.players)
+            self.players.append(player)
         else:
-            self.setJettonMoney(info[0], int(info[1]), int(info[2]))
+            player.jetton = int(info[1])
+            player.money = int(info[2])
+        player.hands += 1
 
     def addActive(self, pid, value):
         player = self.findPlayer(pid)
-        player['active'] += value
-        player['activeCount'] += 1
+        player.active += value
+        player.activeCount += 1
+
+    # A row of inquire/ or notify/: one lookup for its chips and, unless
+    # active is None, its activity
+    def updateRow(self, pid, jetton, money, active):
+        player = self.players[self.index[pid]]
+        player.jetton = jetton
+        player.money = money
+        if active is not None:
+            player.active += active
+            player.activeCount += 1
+
+    # Return: OpponentStats.FIELDS of pid from earlier matches, None
+    def pastStats(self, pid):
+        if self.stats is None:
+            return None
+        return self.stats.get(pid)
+
+    # The counters of this match since the last call go to stats, at
+    # hand ends
+    def saveStats(self):
+        if self.stats is None or not self.recording:
+            return
+        deltas = {}
+        for player in self.players:
+            if player.pid == self.state['mypid']:
+                continue
+            values = tuple(getattr(player, name) for name in OpponentStats.FIELDS)
+            saved = self.saved.get(player.pid)
+            if saved != values:
+                deltas[player.pid] = values if saved is None else \
+                    tuple(a - b for a, b in zip(values, saved))
+                self.saved[player.pid] = values
+        self.stats.add(deltas)
 
     def averageActive(self, pid):
-        if self.findPlayer(pid)['activeCount'] == 0:
+        player = self.findPlayer(pid)
+        active, count = player.active, player.activeCount
+        past = self.pastStats(pid)
+        if past is not None:
+            active += past[1]
+            count += past[2]
+        if count == 0:
             return 0.0
-        return self.findPlayer(pid)['active'] * 1.0 / \
-               self.findPlayer(pid)['activeCount']
+        return active * 1.0 / count
 
     def addHandCount(self):
         self.state['handCount'] += 1
@@ -128,86 +229,263 @@ class PokerState:
         return self.state['round']
 
     def addShowdownCount(self, pid):
-        player = self.findPlayer(pid)
-        player['showdownCount'] += 1
+        self.findPlayer(pid).showdownCount += 1
         
     def getShowdownRate(self, pid):
-        if self.getHandCount() == 0:
+        player = self.findPlayer(pid)
+        hands, count = player.hands, player.showdownCount
+        past = self.pastStats(pid)
+        if past is not None:
+            hands += past[0]
+            count += past[3]
+        if hands == 0:
             return 0.0
-        return self.findPlayer(pid)['showdownCount'] * 1.0 / self.getHandCount()
+        return count * 1.0 / hands
 
     def addWinCount(self, pid):
-        player = self.findPlayer(pid)
-        player['winCount'] += 1
+        self.findPlayer(pid).winCount += 1
         
     def getWinRate(self, pid):
-        if self.getHandCount() == 0:
+        player = self.findPlayer(pid)
+        hands, count = player.hands, player.winCount
+        past = self.pastStats(pid)
+        if past is not None:
+            hands += past[0]
+            count += past[4]
+        if hands == 0:
             return 0.0
-        return self.findPlayer(pid)['winCount'] * 1.0 / self.getHandCount()
+        return count * 1.0 / hands
     
     def setJettonMoney(self, pid, jetton, money):
         player = self.findPlayer(pid)
-        player['jetton'] = jetton
-        player['money'] = money
+        player.jetton = jetton
+        player.money = money
 
     def getHold(self):
-        return tuple(self.state['hold'])
+        return self.state['hold']
 
     def getFTR(self):
-        return tuple(self.state['ftr'])
+        return self.state['ftr']
     
     def getCards(self):
-        return tuple(self.state['hold'] + self.state['ftr'])
+        return self.state['hold'] + self.state['ftr']
+
+    def getCardsMask(self):
+        return self.state['cardsMask']
 
     def getMoneyAndJetton(self, pid):
         player = self.findPlayer(pid)
-        return player['jetton'] + player['money']
+        return player.jetton + player.money
 
     def getMyMoneyAndJetton(self):
         return self.getMoneyAndJetton(self.state['mypid'])
 
     def getMyJetton(self):
-        player = self.findPlayer(self.state['mypid'])
-        return player['jetton']
+        return self.findPlayer(self.state['mypid']).jetton
     
     def cleanOnlines(self):
-        self.state['onlines'] = []
+        self.onlines = []
+        self.onlineSet = set()
 
+    # Return: [pid, ...], don't modify
     def getOnlines(self):
-        return self.state['onlines']
+        return self.onlines
+
+    def isOnline(self, pid):
+        return pid in self.onlineSet
 
     def getPlayers(self):
-        players = []
-        for player in self.state['players']:
-            players.append(player['pid'])
-        return players
+        return [player.pid for player in self.players]
     
+# Sends fallback with send() after timeout seconds unless claim() is
+# called first; exactly one of the two replies goes out.
+class ReplyGuard:
+    def __init__(self, send, fallback, timeout):
+        self.send = send
+        self.fallback = fallback
+        self.lock = threading.Lock()
+        self.replied = False
+        self.timer = threading.Timer(timeout, self.__expire)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def __expire(self):
+        with self.lock:
+            if self.replied:
+                return
+            self.replied = True
+        self.send(self.fallback)
+
+    # Return: True if the caller should send its own reply
+    def claim(self):
+        self.timer.cancel()
+        with self.lock:
+            if self.replied:
+                return False
+            self.replied = True
+            return True
+
+# Splits the server stream into messages. Bytes go into one bytearray
+# and each byte is looked at once: complete lines are checked against
+# the closing line of the message they are in ('/seat' for 'seat/', the
+# 'common/' block inside showdown is just lines), so a message is
+# returned as soon as its last line arrives, however the stream was cut.
+class MessageFramer:
+    def __init__(self):
+        self.buf = bytearray()
+        # next byte to scan for an eol
+        self.scan = 0
+        # first byte of the message being read
+        self.start = 0
+        # its closing line, None between messages
+        self.closing = None
+
+    # data: string<received bytes>
+    # Return: [string<message>, ...] completed by data, in order
+    def feed(self, data):
+        buf = self.buf
+        buf.extend(data)
+        messages = []
+        while True:
+            eol = buf.find('\n', self.scan)
+            if eol == -1:
+                break
+            line = str(buf[self.scan:eol]).strip()
+            self.scan = eol + 1
+            if self.closing is None:
+                if line == 'game-over':
+                    messages.append(str(buf[self.start:self.scan]))
+                    self.start = self.scan
+                elif line.endswith('/'):
+                    self.closing = '/' + line[:-1]
+                else:
+                    # blank or stray line between messages
+                    self.start = self.scan
+            elif line == self.closing:
+                messages.append(str(buf[self.start:self.scan]))
+                self.closing = None
+                self.start = self.scan
+        if self.start:
+            del buf[:self.start]
+            self.scan -= self.start
+            self.start = 0
+        return messages
+
+# Typed records of server messages, made by parseMessage. Numbers are
+# ints and cards are int<card> (see PokerUtils.CARD_OF).
+PlayerRow = collections.namedtuple('PlayerRow', 'pid jetton money')
+ActionRow = collections.namedtuple('ActionRow', 'pid jetton money bet action')
+ShowdownRow = collections.namedtuple('ShowdownRow', 'rank pid hold nut')
+# seat/: button first, then the blinds, then the others
+Seat = collections.namedtuple('Seat', 'players')
+# blind/: ((pid, bet), ...), small blind first
+Blind = collections.namedtuple('Blind', 'bets')
+# hold/ flop/ turn/ river/
+Cards = collections.namedtuple('Cards', 'street cards')
+# inquire/ notify/
+Actions = collections.namedtuple('Actions', 'kind rows pot')
+Showdown = collections.namedtuple('Showdown', 'board ranks')
+# pot-win/: ((pid, num), ...)
+PotWin = collections.namedtuple('PotWin', 'wins')
+GameOver = collections.namedtuple('GameOver', '')
+
+def _parseSeat(lines):
+    players = []
+    for line in lines:
+        fields = line[line.find(':') + 1:].split()
+        players.append(PlayerRow(fields[0], int(fields[1]), int(fields[2])))
+    return Seat(tuple(players))
+
+def _parseBlind(lines):
+    bets = []
+    for line in lines:
+        pid, bet = line.split(': ')
+        bets.append((pid, int(bet)))
+    return Blind(tuple(bets))
+
+def _parseCards(street):
+    return lambda lines: Cards(street, tuple(CARD_OF[line] for line in lines))
+
+def _parseActions(kind):
+    def parse(lines):
+        rows = []
+        pot = None
+        for line in lines:
+            fields = line.split(' ')
+            if fields[0] == 'total':
+                pot = int(fields[2])
+            else:
+                rows.append(ActionRow(fields[0], int(fields[1]), int(fields[2]),
+                                      int(fields[3]), fields[4]))
+        return Actions(kind, tuple(rows), pot)
+    return parse
+
+def _parseShowdown(lines):
+    end = lines.index('/common')
+    ranks = []
+    for line in lines[end + 1:]:
+        rank, rest = line.split(': ')
+        fields = rest.split(' ')
+        ranks.append(ShowdownRow(int(rank), fields[0],
+                                 (CARD_OF[fields[1] + ' ' + fields[2]],
+                                  CARD_OF[fields[3] + ' ' + fields[4]]), fields[5]))
+    return Showdown(tuple(CARD_OF[line] for line in lines[1:end]), tuple(ranks))
+
+def _parsePotWin(lines):
+    wins = []
+    for line in lines:
+        pid, num = line.split(': ')
+        wins.append((pid, int(num)))
+    return PotWin(tuple(wins))
+
+MESSAGE_PARSERS = {
+    'seat': _parseSeat,
+    'blind': _parseBlind,
+    'hold': _parseCards('hold'),
+    'flop': _parseCards('flop'),
+    'turn': _parseCards('turn'),
+    'river': _parseCards('river'),
+    'showdown': _parseShowdown,
+    'pot-win': _parsePotWin,
+    'inquire': _parseActions('inquire'),
+    'notify': _parseActions('notify')
+    }
+
+# message: one complete message, see MessageFramer
+# Return: its record, one pass over the lines between 'tag/' and '/tag'
+def parseMessage(message):
+    lines = [line.strip() for line in message.split('\n')]
+    if lines[0] == 'game-over':
+        return GameOver()
+    tag = lines[0][:-1]
+    return MESSAGE_PARSERS[tag](lines[1:lines.index('/' + tag)])
+
 class PokerMessage:
-    def __init__(self, ps):
+    # workers, speculate: see PokerAlgorithm
+    # tracer: PokerTrace.Tracer timing each inquire, None for no tracing
+    # history: PokerHistory.HistoryWriter getting every message and
+    #     decision, None for no history
+    def __init__(self, ps, workers = 0, speculate = True, tracer = None, history = None):
         self.ps = ps
-        self.pa = PokerAlgorithm(0, ps)
+        self.pa = PokerAlgorithm(0, ps, workers, speculate)
+        # send(reply), lets a fallback reply go out before the inquire
+        # deadline while a decision is still running; None disables it
+        self.send = None
+        self.tracer = tracer
+        if tracer is not None:
+            tracer.attach(self.pa)
+        self.history = history
+        # print the equity cache stats at game-over
+        self.DEBUG = False
         self.entries = {
-            'seat/': self.__seat,
-            'game-over': self.__game_over,
-            'blind/': self.__blind,
-            'hold/': self.__hold,
-            'flop/': self.__flop,
-            'turn/': self.__turn,
-            'river/': self.__river,
-            'showdown/': self.__showdown,
-            'pot-win/': self.__pot_win,
-            'inquire/': self.__inquire,
-            'notify/': self.__notify
+            Seat: self.__seat,
+            GameOver: self.__game_over,
+            Blind: self.__blind,
+            Cards: self.__cards,
+            Showdown: self.__showdown,
+            PotWin: self.__pot_win,
+            Actions: self.__actions
             }
-        
-    def __readline(self):
-        return self.msg_buf.readline().strip()
-    
-    def __readlines(self):
-        ret = []
-        for line in self.msg_buf.readlines():
-            ret.append(line.strip())
-        return ret
 
     def isClosed(self, msg):
         closeList = ['/seat', '/blind', '/hold', '/flop',
@@ -215,14 +493,7 @@ class PokerMessage:
                      '/pot-win', '/inquire', '/notify', 'game-over']
         return (msg.strip().split('\n')[-1].strip() in closeList)
         
-    def __get_point(self, point):
-        L = ['J', 'Q', 'K', 'A']
-        if point in L:
-            return 11 + L.index(point)
-        else:
-            return int(point)
-        
-    def __seat(self):
+    def __seat(self, seat):
         '''
         seat/ eol
         button: pid jetton money eol
@@ -232,90 +503,49 @@ class PokerMessage:
         /seat eol
         '''
         self.ps.cleanOnlines()
-        player = self.__readline().split(': ')[1].split(' ')
-        self.ps.addPlayer(player)
-        self.ps.setButton(player[0])
-        for _player in self.__readlines():
-            if _player == '/seat':
-                break
-            if _player.find('blind') != -1:
-                player = _player.split(':')[1].strip().split(' ')
-                self.ps.addPlayer(player)
-            else:
-                player = _player.split(' ')
-                self.ps.addPlayer(player)
+        for player in seat.players:
+            self.ps.addPlayer(player)
+        self.ps.setButton(seat.players[0].pid)
         self.ps.cleanState()
         self.ps.setRound('seat')
         self.ps.addHandCount()
         
-    def __game_over(self):
+    def __game_over(self, gameOver):
         '''
         game-over eol
         '''
+        if self.DEBUG:
+            print('equity cache: %s' % self.pa.pu.cache.stats())
+        if self.tracer is not None:
+            self.tracer.dump()
+        self.ps.saveStats()
+        self.pa.close()
         return 'game-over'
     
-    def __blind(self):
+    def __blind(self, blind):
         '''
         blind/ eol
         (pid: bet eol)1-2
         /blind eol
         '''
-        blind = self.__readline().split(': ')
-        self.ps.setBlind(int(blind[1]))
+        self.ps.setBlind(blind.bets[0][1])
         self.ps.setRound('blind')
             
-    def __hold(self):
+    def __cards(self, cards):
         '''
         hold/ eol
-        color point eol
-        color point eol
+        (color point eol)2
         /hold eol
+        flop/, turn/, river/: 3, 1, 1 cards the same way
         '''
-        for _card in self.__readlines():
-            if _card == '/hold':
-                break
-            card = _card.split(' ')
-            self.ps.addCard('hold', (card[0], self.__get_point(card[1])))
-        self.ps.setRound('hold')
-        self.pa.isBluffed = False
-        
-    def __flop(self):
-        '''
-        flop/ eol
-        color point eol
-        color point eol
-        color point eol
-        /flop eol
-        '''
-        for _card in self.__readlines():
-            if _card == '/flop':
-                break
-            card = _card.split(' ')
-            self.ps.addCard('ftr', (card[0], self.__get_point(card[1])))
-        self.ps.setRound('flop')
-        self.pa.isBluffed = False
-        
-    def __turn(self):
-        '''
-        turn/ eol
-        color point eol
-        /turn eol
-        '''
-        card = self.__readline().split(' ')
-        self.ps.addCard('ftr', (card[0], self.__get_point(card[1])))
-        self.ps.setRound('turn')
+        for card in cards.cards:
+            self.ps.addCard('hold' if cards.street == 'hold' else 'ftr', card)
+        self.ps.setRound(cards.street)
+        self.pa.speculate()
+        if cards.street in ('hold', 'flop'):
+            self.pa.isBluffed = False
         
-    def __river(self):
-        '''
-        river/ eol
-        color point eol
-        /river eol
-        '''
-        card = self.__readline().split(' ')
-        self.ps.addCard('ftr', (card[0], self.__get_point(card[1])))
-        self.ps.setRound('river')
-        
-    def __showdown(self):
+    def __showdown(self, showdown):
         '''
         showdown/ eol
         common/ eol
@@ -324,85 +554,96 @@ class PokerMessage:
         (rank: pid color point color point nut_hand eol)2-8
         /showdown eol
         '''
-        isRank = False
-        for _rank in self.__readlines():
-            if _rank == 'common/':
-                continue
-            if _rank == '/common':
-                isRank = True
-                continue
-            if _rank == '/showdown':
-                break
-            if isRank:
-                rank = _rank.split(': ')[1].split(' ')
-                # TODO: Get more infomation.
-                self.ps.addShowdownCount(rank[0])
-            else:
-                # Not needed now.
-                common = _rank.split(' ')
+        for rank in showdown.ranks:
+            # TODO: Get more infomation.
+            self.ps.addShowdownCount(rank.pid)
         self.ps.setRound('showdown')
+        self.pa.speculate()
                 
-    def __pot_win(self):
+    def __pot_win(self, potWin):
         '''
         pot-win/ eol
         (pid: num eol)0-8
         /pot-win eol
         '''
-        for _win in self.__readlines():
-            if _win == '/pot-win':
-                break
-            pid, num = _win.split(':')
+        for pid, num in potWin.wins:
             self.ps.addWinCount(pid)
+        self.ps.saveStats()
+        self.pa.handOver()
             
-    def __inquire(self):
+    def __actions(self, actions):
         '''
         inquire/ eol
         (pid jetton money bet blind | check | call | raise | all_in | fold eol)1-8
         total pot: num eol
         /inquire eol
+        notify/: the same rows, no reply
         '''
-        players = []
-        for _inquire in self.__readlines():
-            if _inquire == '/inquire':
-                break
-            if _inquire.find('total pot') == -1:
-                inquire = _inquire.split(' ')
-                players.append(inquire)
-                if inquire[4] != 'blind':
-                    self.ps.addActive(inquire[0], self.pa.activeValue[inquire[4]])
-                self.ps.setJettonMoney(inquire[0], int(inquire[1]), int(inquire[2]))
-            else:
-                self.ps.setPot(int(_inquire.split(': ')[1]))
-        reply = self.pa.replyHandler(tuple(players)) + ' \n'
+        if self.tracer is not None:
+            start = time.time()
+        activeValue = self.pa.activeValue
+        for row in actions.rows:
+            self.ps.updateRow(row.pid, row.jetton, row.money,
+                              activeValue[row.action]
+                              if actions.kind == 'notify' or row.action != 'blind' else None)
+        if actions.pot is not None:
+            self.ps.setPot(actions.pot)
+        if actions.kind == 'inquire':
+            if self.tracer is not None:
+                self.tracer.stage('state', start)
+            return self.__inquire(actions.rows)
+
+    def __decide(self, players):
+        if self.tracer is None:
+            return self.pa.replyHandler(players) + ' \n'
+        reply = self.tracer.decide(self.pa.replyHandler, players)
+        self.tracer.trace['reply'] = reply
+        return reply + ' \n'
+
+    def __inquire(self, players):
+        if self.send is None:
+            return self.__decide(players)
+        fallback = self.pa.fallbackReply(players)
+        guard = ReplyGuard(self.send, fallback + ' \n', self.pa.getBudget())
+        reply = self.__decide(players)
+        if guard.claim():
+            return reply
+        # too late, the fallback went out instead and is what we did
+        self.pa.decisions[-1]['fallback'] = True
+        self.pa.decisions[-1]['reply'] = fallback
+        if self.tracer is not None:
+            self.tracer.trace['fallback'] = True
+            self.tracer.trace['reply'] = fallback
+        if fallback == 'fold':
+            self.pa.folded()
+        return None
+
+    # message: one complete message, see MessageFramer
+    # Return: reply to send, 'game-over', or None
+    def handle(self, message):
+        if self.tracer is None:
+            record = parseMessage(message)
+        else:
+            start = time.time()
+            record = parseMessage(message)
+            if type(record) is Actions and record.kind == 'inquire':
+                self.tracer.begin(self.ps.getHandCount(), self.ps.getRound())
+                self.tracer.stage('parse', start)
+        if self.history is None:
+            return self.entries[type(record)](record)
+        self.history.record(record)
+        reply = self.entries[type(record)](record)
+        if type(record) is Actions and record.kind == 'inquire':
+            self.history.decision(self.ps.getHandCount(), self.pa.decisions[-1])
         return reply
-    
-    def __notify(self):
-        '''
-        notify/ eol
-        (pid jetton money bet blind | check | call | raise | all_in | fold eol)1-8
-        total pot: num eol
-        /notify eol
-        '''
-        for _notify in self.__readlines():
-            if _notify == '/notify':
-                break
-            if _notify.find('total pot') == -1:
-                notify = _notify.split(' ')
-                self.ps.addActive(notify[0], self.pa.activeValue[notify[4]])
-                self.ps.setJettonMoney(notify[0],
-                                       int(notify[1]), int(notify[2]))
-            else:
-                self.ps.setPot(int(_notify.split(': ')[1]))
-                
+
     def msgHandler(self, msg):
         if not self.isClosed(msg):
             return 'waiting'
         patt = r'((?P<TypeTag>[^/]+)/[\s\S]+?/(?P=TypeTag)|game-over)'
         results = re.findall(patt, msg)
         for result in results:
-            self.msg_buf = StringIO.StringIO(result[0])
-            msg_type = self.__readline()
-            reply = self.entries[msg_type]()
+            reply = self.handle(result[0] + '\n')
             if reply:
                 return reply
             
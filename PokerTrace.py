@@ -0,0 +1,155 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+
+import cProfile, collections, json, os, sys, time
+
+# PokerUtils and EquitySpeculator calls timed as stages of a trace
+TRACED_UTILS = ('loseRate', 'adaptiveHS', 'HS', 'exactOdds', 'emulateHS', 'merge')
+TRACED_SPECULATOR = ('take', 'pause')
+
+# Opt-in timing of every inquire/ round trip, from the recv that brought
+# it in to the send of the reply. A trace is
+#   {'match', 'hand', 'round', 'reply', 'fallback', 'total': ms,
+#    'stages': [[stage, ms from recv, ms], ...], 'profile': file}
+# with stages recv, frame, parse, state, decision, send and the traced
+# equity calls inside the decision. dump() appends them to path as one
+# JSON object per line; summarize() reads any number of those files.
+class Tracer:
+    # slow: seconds, decisions run under cProfile and the ones slower
+    #     than this keep their stats in path.<match>.<n>.prof. Every
+    #     decision is profiled, there is no telling a slow one in
+    #     advance, so its decision stage includes the profiler's
+    #     overhead (~35% on the flop); leave it None to time decisions
+    # match: name of this match in the traces, start time if None
+    def __init__(self, path, slow = None, match = None):
+        self.path = path
+        self.slow = slow
+        self.match = match or time.strftime('%Y%m%d-%H%M%S-') + str(os.getpid())
+        self.traces = []
+        self.profiles = []
+        # the trace being taken, None between inquires
+        self.trace = None
+        # last received(): when the data came and seconds framing it
+        self.recvAt = None
+        self.frameTime = 0.0
+
+    def received(self, at, frameTime):
+        self.recvAt = at
+        self.frameTime = frameTime
+
+    def begin(self, hand, street):
+        self.end()
+        now = time.time()
+        self.trace = {
+            'match': self.match,
+            'hand': hand,
+            'round': street,
+            'reply': None,
+            'fallback': False,
+            't0': now if self.recvAt is None else self.recvAt,
+            'stages': []
+            }
+        if self.recvAt is not None:
+            self.stage('recv', self.recvAt, self.recvAt)
+            self.stage('frame', self.recvAt, self.recvAt + self.frameTime)
+            self.recvAt = None
+
+    # end: time.time() if None
+    def stage(self, name, start, end = None):
+        if self.trace is None:
+            return
+        end = time.time() if end is None else end
+        self.trace['stages'].append([name, round((start - self.trace['t0']) * 1000, 3),
+                                     round((end - start) * 1000, 3)])
+
+    # pa: PokerAlgorithm, its equity calls become stages
+    def attach(self, pa):
+        self.instrument(pa.pu, TRACED_UTILS)
+        if pa.speculator is not None:
+            self.instrument(pa.speculator, TRACED_SPECULATOR)
+
+    # Times obj.name() for names as stages while a trace is open
+    def instrument(self, obj, names):
+        for name in names:
+            setattr(obj, name, self.__timed(name, getattr(obj, name)))
+
+    def __timed(self, name, method):
+        def timed(*args, **kwargs):
+            if self.trace is None:
+                return method(*args, **kwargs)
+            start = time.time()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.stage(name, start)
+        return timed
+
+    # Return: func(*args), timed as the decision stage
+    def decide(self, func, *args):
+        if self.slow is None or self.trace is None:
+            start = time.time()
+            result = func(*args)
+            self.stage('decision', start)
+            return result
+        profile = cProfile.Profile()
+        start = time.time()
+        result = profile.runcall(func, *args)
+        end = time.time()
+        self.stage('decision', start, end)
+        if end - start > self.slow:
+            self.trace['profile'] = '%s.%s.%d.prof' % (self.path, self.match, len(self.profiles))
+            self.profiles.append(profile)
+        return result
+
+    # start: time.time() before the reply was sent
+    def sent(self, start):
+        self.stage('send', start)
+        self.end()
+
+    def end(self):
+        trace = self.trace
+        if trace is None:
+            return
+        self.trace = None
+        trace['total'] = max([start + ms for name, start, ms in trace['stages']] or [0.0])
+        del trace['t0']
+        self.traces.append(trace)
+
+    # Appends the traces to path, writes the kept profiles
+    def dump(self):
+        self.end()
+        with open(self.path, 'a') as f:
+            for trace in self.traces:
+                f.write(json.dumps(trace, separators = (',', ':'), sort_keys = True) + '\n')
+        for idx, profile in enumerate(self.profiles):
+            profile.dump_stats('%s.%s.%d.prof' % (self.path, self.match, idx))
+        self.traces = []
+        self.profiles = []
+
+# Return: [values at quantile q, ...] by nearest rank, 0.0 each if empty
+def percentiles(values, qs = (0.5, 0.9, 0.99, 1.0)):
+    values = sorted(values) or [0.0]
+    return [values[int(round(q * (len(values) - 1)))] for q in qs]
+
+# Return: {(round, stage): [ms, ...]} over the traces in paths, the
+# whole round trip as stage 'total'
+def summarize(paths):
+    times = collections.defaultdict(list)
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                trace = json.loads(line)
+                times[(trace['round'], 'total')].append(trace['total'])
+                for name, start, ms in trace['stages']:
+                    times[(trace['round'], name)].append(ms)
+    return times
+
+if __name__ == '__main__':
+    # python PokerTrace.py trace ...
+    times = summarize(sys.argv[1:])
+    print('%-6s %-11s %8s %9s %9s %9s %9s' %
+          ('round', 'stage', 'count', 'mean ms', 'p50 ms', 'p90 ms', 'max ms'))
+    for (street, name), ms in sorted(times.iteritems()):
+        print('%-6s %-11s %8d %9.3f %9.3f %9.3f %9.3f' %
+              ((street, name, len(ms), sum(ms) / len(ms)) +
+               tuple(percentiles(ms, (0.5, 0.9, 1.0)))))
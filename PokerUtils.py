@@ -1,14 +1,281 @@
 #!/usr/bin/python
 # -*- encoding: utf-8 -*-
 
-import itertools, operator, random
+import bisect, collections, itertools, math, multiprocessing, operator, random, sys, threading, time
 from deuces import Card, Evaluator
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Cards are ints 0-51 from the protocol parser to the evaluator:
+# card = color * 13 + point - 2, color: SPADES 0, HEARTS 1, CLUBS 2,
+# DIAMONDS 3, point: 2-14 (same order as deuces Card.INDEX_SUITS)
+COLORS = ['SPADES', 'HEARTS', 'CLUBS', 'DIAMONDS']
+POINTS = ['2', '3', '4', '5', '6', '7', '8', '9', '10', 'J', 'Q', 'K', 'A']
+# protocol card line 'color point' => card
+CARD_OF = dict(('%s %s' % (color, point), i * 13 + j)
+               for i, color in enumerate(COLORS)
+               for j, point in enumerate(POINTS))
+CARD_COLOR = [card / 13 for card in range(52)]
+CARD_POINT = [card % 13 + 2 for card in range(52)]
+# sets of cards are 52-bit masks
+CARD_BIT = [1 << card for card in range(52)]
+ALL_CARDS = range(52)
+
+# Best rank of every opponent hold on one board, sorted so that "how many
+# holds beat / tie rank r" is a binary search. Each card also keeps the
+# sorted ranks of the holds containing it, which takes the hero's own
+# (dead) cards back out for any hero hand on the same board.
+class BoardRanks:
+    # ftr: (int<card>, ...), 3-5 cards
+    def __init__(self, pu, ftr):
+        self.board = tuple(sorted(ftr))
+        self.holds = list(itertools.combinations(pu.restCards(self.board), 2))
+        if pu.pool is not None and pu.pool.alive():
+            self.ranks = pu.pool.rankHolds(self.board, self.holds, pu.deadline)
+        else:
+            self.ranks = pu.rankHolds(self.board, self.holds)
+        self.sortedRanks = sorted(self.ranks)
+        self.holdRank = dict(itertools.izip(self.holds, self.ranks))
+        self.cardRanks = [[] for card in range(52)]
+        for hold, rank in itertools.izip(self.holds, self.ranks):
+            self.cardRanks[hold[0]].append(rank)
+            self.cardRanks[hold[1]].append(rank)
+        for ranks in self.cardRanks:
+            ranks.sort()
+
+    # hold: (int<card>, int<card>), not on the board
+    # Return: (holds beating myRank, holds tying it, live holds)
+    def count(self, hold, myRank):
+        a, b = sorted(hold)
+        beat = bisect.bisect_left(self.sortedRanks, myRank) - \
+               bisect.bisect_left(self.cardRanks[a], myRank) - \
+               bisect.bisect_left(self.cardRanks[b], myRank)
+        upto = bisect.bisect_right(self.sortedRanks, myRank) - \
+               bisect.bisect_right(self.cardRanks[a], myRank) - \
+               bisect.bisect_right(self.cardRanks[b], myRank)
+        # (a, b) itself was taken out twice
+        own = self.holdRank[(a, b)]
+        if own < myRank:
+            beat += 1
+        if own <= myRank:
+            upto += 1
+        total = len(self.holds) - len(self.cardRanks[a]) - \
+                len(self.cardRanks[b]) + 1
+        return beat, upto - beat, total
+
+# LRU cache for equity results, bounded by entries and by an estimate of
+# the bytes held (keys and values are small tuples of ints/floats).
+# maxEntries = 0 turns it off.
+class EquityCache:
+    def __init__(self, maxEntries = 4096, maxBytes = 4 << 20):
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __sizeof(self, key, value):
+        size = sys.getsizeof(key) + sys.getsizeof(value)
+        for item in key:
+            size += sys.getsizeof(item)
+        return size
+
+    # Return: value, None on a miss
+    def get(self, key):
+        value = self.entries.pop(key, None)
+        if value is None:
+            self.misses += 1
+            return None
+        self.entries[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if self.maxEntries <= 0:
+            return
+        if key in self.entries:
+            self.bytes -= self.__sizeof(key, self.entries.pop(key))
+        self.entries[key] = value
+        self.bytes += self.__sizeof(key, value)
+        while len(self.entries) > self.maxEntries or \
+              (self.bytes > self.maxBytes and len(self.entries) > 1):
+            oldKey, oldValue = self.entries.popitem(last = False)
+            self.bytes -= self.__sizeof(oldKey, oldValue)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+            }
+
+# Worker side of EquityPool: one PokerUtils per worker process, and one
+# per thread running the in-process fallback (PokerUtils on several
+# threads can share a pool). Its Evaluator maps the prebuilt table
+# file, so starting one is cheap.
+_workerLocal = threading.local()
+
+def _workerUtils():
+    utils = getattr(_workerLocal, 'utils', None)
+    if utils is None:
+        utils = _workerLocal.utils = PokerUtils()
+    return utils
+
+def _initWorker():
+    _workerUtils()
+
+# args: (hold, ftr, playerCount, count, seed)
+def _emulateWins(args):
+    hold, ftr, playerCount, count, seed = args
+    utils = _workerUtils()
+    utils.seed(seed)
+    return utils.emulateWins(hold, ftr, playerCount, count)
+
+# args: (board, [hold, ...])
+def _rankHolds(args):
+    return _workerUtils().rankHolds(*args)
+
+# Persistent process pool splitting HS trials and loseRate hold ranges
+# across workers. A call waits for the pool until the caller's deadline,
+# at most timeout seconds, then runs in this process. The pool is only
+# given up on for good (every PokerUtils sharing it then computes in
+# process) when it fails hard: a worker died or a call raised, or
+# maxStrikes calls in a row waited out the whole timeout.
+class EquityPool:
+    def __init__(self, workers, timeout = 2.0):
+        self.workers = workers
+        self.timeout = timeout
+        self.maxStrikes = 3
+        # calls in a row that waited out timeout
+        self.strikes = 0
+        try:
+            self.pool = multiprocessing.Pool(workers, _initWorker)
+            self.pids = self.__pids(self.pool)
+        except (OSError, ImportError):
+            self.pool = None
+
+    # False once the pool was given up on
+    def alive(self):
+        return self.pool is not None
+
+    def __split(self, count):
+        return [count / self.workers + (idx < count % self.workers)
+                for idx in range(self.workers)]
+
+    # The pool starts a new worker for one that died, so a changed set
+    # of pids means a lost task
+    def __pids(self, pool):
+        return set(process.pid for process in pool._pool)
+
+    # deadline: time.time() to give up on the pool at, None for timeout
+    def __map(self, func, chunks, deadline = None):
+        pool = self.pool
+        if pool is not None:
+            timeout = self.timeout
+            if deadline is not None:
+                timeout = min(timeout, deadline - time.time())
+            if timeout > 0:
+                try:
+                    result = pool.map_async(func, chunks, 1).get(timeout)
+                    self.strikes = 0
+                    return result
+                except multiprocessing.TimeoutError:
+                    if self.__pids(pool) != self.pids:
+                        self.__abandon()
+                    elif timeout >= self.timeout:
+                        self.strikes += 1
+                        if self.strikes >= self.maxStrikes:
+                            self.__abandon()
+                except Exception:
+                    self.__abandon()
+        return map(func, chunks)
+
+    # seed: chunk idx runs on its own stream seeded with seed + idx
+    # deadline: see __map
+    # Return: wins out of count trials
+    def emulateWins(self, hold, ftr, playerCount, count, seed, deadline = None):
+        chunks = [(hold, tuple(ftr), playerCount, n, seed + idx)
+                  for idx, n in enumerate(self.__split(count)) if n]
+        return sum(self.__map(_emulateWins, chunks, deadline))
+
+    # Return: [rank of board + hold, ...]
+    def rankHolds(self, board, holds, deadline = None):
+        chunks = []
+        start = 0
+        for n in self.__split(len(holds)):
+            chunks.append((board, holds[start:start + n]))
+            start += n
+        return list(itertools.chain.from_iterable(self.__map(_rankHolds, chunks, deadline)))
+
+    # A failed pool may not even terminate (a worker killed while holding
+    # the task queue lock), so that is left to a daemon thread
+    def __abandon(self):
+        pool, self.pool = self.pool, None
+        if pool is not None:
+            thread = threading.Thread(target = pool.terminate)
+            thread.daemon = True
+            thread.start()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
 
 class PokerUtils:
-    def __init__(self):
-        self.emulateCount = 1000
+    # workers: > 1 runs HS and loseRate on a process pool of that size,
+    # 0 or 1 computes in this process (one worker would only add the
+    # round trip); or an EquityPool shared with other PokerUtils, left
+    # open by close()
+    # seed: for the random streams, see seed()
+    def __init__(self, workers = 0, seed = None):
+        # HS trials; batched numpy trials are about 10x cheaper
+        self.emulateCount = 10000 if np is not None else 1000
+        # batched trials dealt at once
+        self.emulateChunk = 10000
+        # adaptiveHS: trials per batch, most trials per spot
+        self.emulateBatch = 100
+        self.emulateMax = 4000
+        # fewer trials than this run in process, the pool round trip
+        # would cost more than the trials (a lone adaptiveHS batch)
+        self.poolTrials = 2 * self.emulateBatch
+        # with a pool, adaptiveHS deals this many trials per worker per
+        # batch; 100 trials (numpy or not) cost about the round trip
+        self.poolBatch = 10 * self.emulateBatch
+        # exactOdds enumerates spots needing at most this many evaluations
+        self.exactLimit = 50000
+        # lookahead evaluates grids of at most this many cells, in chunks
+        # of about lookaheadChunk cells to bound its memory
+        self.lookaheadLimit = 2500000
+        self.lookaheadChunk = 100000
+        # time.time() after which adaptiveHS returns what it has, and
+        # exactOdds and lookahead give up (None) between grid chunks;
+        # loseRate always finishes, a cold board costs one BoardRanks
+        self.deadline = None
+        # callable, returning True stops the same work as the deadline
+        self.interrupt = None
         self.maxRank = 7462
-        self.evaluator = Evaluator()
+        self.evaluator = Evaluator('direct')
+        self.lastBoardRanks = None
+        self.lastBoardState = None
+        # last table merge() stored
+        self.lastLookahead = None
+        self.cache = EquityCache()
+        if isinstance(workers, EquityPool):
+            self.pool, self.ownPool = workers, False
+        else:
+            self.pool, self.ownPool = EquityPool(workers) if workers > 1 else None, True
+        self.seed(seed)
         self.color = {
             'SPADES': 0,
             'HEARTS': 1,
@@ -20,6 +287,9 @@ class PokerUtils:
         self.rPoint = ['2', '3', '4', '5', '6', '7',
                        '8', '9', 'T', 'J', 'Q', 'K', 'A']
         self.ePoint = self.rPoint
+        if np is not None:
+            # card => deuces card int
+            self.deucesArray = np.array(Card.INDEX_TO_INT, dtype = np.int64)
         self.type = {
             'HIGH_CARD': 0,
             'ONE_PAIR': 1,
@@ -103,6 +373,7 @@ class PokerUtils:
         return ' '.join([self.rColor[card[0]] + self.rPoint[card[1]] \
                          for card in cards])
     
+    # (string<color>, int<point>) => card, for callers outside the parser
     def toOrigin(self, cards):
         cards = [self.color[card[0]] * 13 + card[1] - 2 for card in cards]
         return cards
@@ -153,77 +424,472 @@ class PokerUtils:
     # The small the better
     # cards: (int<card>, ...)
     def cardsRank(self, cards):
-        evaCards = []
+        return self.evaluator.evaluate_index(cards)
+    
+    # Incremental evaluation state of the board (deuces HandState), grown
+    # from the last one while the board only gains cards: one add per
+    # street, then board + hold costs two primes and two suit counters.
+    # ftr: (int<card>, ...) in any order
+    def boardState(self, ftr):
+        state = self.lastBoardState
+        if state is None or sorted(state.cards) != sorted(ftr):
+            missing = [card for card in ftr if card not in state.cards] \
+                      if state is not None else ftr
+            if state is not None and len(state.cards) + len(missing) == len(ftr):
+                state = state.copy()
+                for card in missing:
+                    state.add(card)
+            else:
+                state = self.evaluator.hand_state(ftr)
+            self.lastBoardState = state
+        return state
+
+    # Evaluate many hands in one call, needs numpy
+    # cards: N x 5/6/7 array of int<card>
+    # Return: N ranks
+    def cardsRankBatch(self, cards):
+        cards = np.asarray(cards, dtype = np.int64)
+        return self.evaluator.evaluate_batch(self.deucesArray[cards])
+    
+    # Ranks of board + rows[i] + cols[j], needs numpy
+    # board: (int<card>, ...), rows/cols: lists of equally long card lists
+    # Return: len(rows) x len(cols) ranks
+    def cardsRankGrid(self, board, rows, cols):
+        table = self.deucesArray
+        return self.evaluator.evaluate_grid(
+            table[np.asarray(board, dtype = np.int64)],
+            table[np.asarray(rows, dtype = np.int64)].reshape(len(rows), -1),
+            table[np.asarray(cols, dtype = np.int64)].reshape(len(cols), -1))
+
+    # cards: (int<card>, ...)
+    # Return: int<mask>
+    # board: (int<card>, ...), holds: [(int<card>, int<card>), ...]
+    # Return: [rank of board + hold, ...]
+    def rankHolds(self, board, holds):
+        if np is not None and holds:
+            return self.cardsRankBatch(np.hstack([np.tile(board, (len(holds), 1)),
+                                                  np.array(holds)])).tolist()
+        state = self.boardState(board)
+        return [state.evaluate_with(a, b) for a, b in holds]
+
+    def cardsMask(self, cards):
+        mask = 0
         for card in cards:
-            evaCards.append(Card.new(self.ePoint[self.getPointOf(card)] + \
-                                     self.eColor[self.getColorOf(card)]))
-        rank = self.evaluator.evaluate(evaCards)
-        return rank
+            mask |= CARD_BIT[card]
+        return mask
     
     def restCards(self, usedCards):
-        mask = [1] * 52
-        for card in usedCards:
-            mask[card] = 0
-        return list(itertools.compress(range(52), mask))
+        mask = self.cardsMask(usedCards)
+        return [card for card in ALL_CARDS if not mask & CARD_BIT[card]]
     
-    def randomChoose(self, restCards, num):
-        return random.sample(set(restCards), num)
+    # Fresh random streams for emulate: random.Random for single trials,
+    # numpy RandomState for batches. seed: None (from the OS) or 0-2**32-1
+    def seed(self, seed = None):
+        self.random = random.Random(seed)
+        self.rng = np.random.RandomState(seed) if np is not None else None
+
+    # num random cards not in usedMask, by rejection: at most 21 of the 52
+    # cards are ever used, so this beats building the rest of the deck
+    def randomChoose(self, usedMask, num):
+        cards = []
+        random = self.random.random
+        while num:
+            card = int(random() * 52)
+            if not usedMask & CARD_BIT[card]:
+                usedMask |= CARD_BIT[card]
+                cards.append(card)
+                num -= 1
+        return cards
         
     def C(self, n, k):
         return  reduce(operator.mul, range(n - k + 1, n + 1)) / \
                reduce(operator.mul, range(1, k +1))
     
-    # hold/ftr: ((string<color>, int<point>), ...)
-    # point: 2-14   
+    # Opponent ranks on a board, the last board is kept so several hero
+    # hands (and streets re-asking) on it are just lookups
+    # ftr: (int<card>, ...)
+    def boardRanks(self, ftr):
+        board = tuple(sorted(ftr))
+        if self.lastBoardRanks is None or self.lastBoardRanks.board != board:
+            self.lastBoardRanks = BoardRanks(self, board)
+        return self.lastBoardRanks
+    
+    # Same situation up to renaming suits => same key. Suits are ordered
+    # by the ranks they hold on the board, then in the hand; suits that
+    # tie hold the same ranks, so their order does not matter.
+    # hold/ftr: (int<card>, ...)
+    # Return: (hold, ftr) sorted, with suits renamed
+    def canonical(self, hold, ftr):
+        signs = [[0, 0], [0, 0], [0, 0], [0, 0]]
+        for card in ftr:
+            signs[CARD_COLOR[card]][0] |= CARD_BIT[card % 13]
+        for card in hold:
+            signs[CARD_COLOR[card]][1] |= CARD_BIT[card % 13]
+        order = sorted(range(4), key = signs.__getitem__, reverse = True)
+        color = [0] * 4
+        for idx, _color in enumerate(order):
+            color[_color] = idx * 13
+        return (tuple(sorted(color[CARD_COLOR[card]] + card % 13 for card in hold)),
+                tuple(sorted(color[CARD_COLOR[card]] + card % 13 for card in ftr)))
+    
+    # Against one random opponent hold
+    # hold/ftr: (int<card>, ...)
+    # Return: (lose %, tie %)
+    def loseTieRate(self, hold, ftr):
+        if len(ftr) < 3:
+            return 0.0, 0.0
+        key = ('loseTieRate',) + self.canonical(hold, ftr)
+        rates = self.cache.get(key)
+        if rates is None:
+            myRank = self.boardState(ftr).evaluate_with(hold[0], hold[1])
+            lose, tie, total = self.boardRanks(ftr).count(hold, myRank)
+            rates = (lose * 100.0 / total, tie * 100.0 / total)
+            self.cache.put(key, rates)
+        return rates
+    
+    # hold/ftr: (int<card>, ...)
     def loseRate(self, hold, ftr):
-        hold = self.toOrigin(hold)
-        ftr = self.toOrigin(ftr)
-        cards = hold + ftr
-        myRank = self.cardsRank(tuple(cards))
-        total = self.C(52 - len(cards), 2)
-        count = 0
-        restCards = self.restCards(cards)
-        for _hold in itertools.combinations(restCards, 2):
-            for _cards in itertools.combinations(ftr + list(_hold), 5):
-                _rank = self.cardsRank(tuple(_cards))
-                if _rank < myRank:
-                    count += 1
-                    break
-                
-        return count * 100.0 / total
+        return self.loseTieRate(hold, ftr)[0]
+
+    # Evaluations exactOdds needs for the spot, None if it can't do it:
+    # one hand per live opponent hold and river. The flop is only exact
+    # once lookahead has run on it. More than 2 opponents is never exact.
+    def exactSize(self, hold, ftr, playerCount):
+        if len(ftr) < 4 or not 1 <= playerCount <= 2:
+            return None
+        if len(ftr) == 5 and playerCount == 1:
+            return self.C(45, 2)
+        if np is None:
+            return None
+        if len(ftr) == 5:
+            return self.C(45, 2)
+        return self.lookaheadSize(ftr)
+
+    # Exact odds against playerCount random holds, by enumerating the
+    # river and the opponent holds; dead cards (ours, the board, the
+    # river) are never dealt to opponents.
+    # Return: (win, tie, lose) probabilities, tie when we split the pot;
+    # None if exactSize is None or over exactLimit, or past the deadline
+    # before a grid, and not cached. No opponent left is a sure win.
+    def exactOdds(self, hold, ftr, playerCount):
+        if playerCount < 1:
+            return 1.0, 0.0, 0.0
+        if len(ftr) < 3:
+            return None
+        key = ('exactOdds',) + self.canonical(hold, ftr) + (playerCount,)
+        odds = self.cache.get(key)
+        if odds is not None:
+            return odds
+        size = self.exactSize(hold, ftr, playerCount)
+        if size is None or size > self.exactLimit:
+            return None
+        # the callers sample instead
+        if (len(ftr) == 4 or playerCount > 1) and self.expired():
+            return None
+        if len(ftr) == 4:
+            done = self.__lookahead(hold, ftr, (playerCount,))
+            return done[1][playerCount] if done is not None else None
+        if playerCount == 1:
+            myRank = self.boardState(ftr).evaluate_with(hold[0], hold[1])
+            lose, tie, total = self.boardRanks(ftr).count(hold, myRank)
+            odds = ((total - lose - tie) * 1.0 / total, tie * 1.0 / total, lose * 1.0 / total)
+        else:
+            holds = np.array(list(itertools.combinations(self.restCards(hold + ftr), 2)))
+            runouts = np.zeros((1, 0), dtype = np.int64)
+            odds = self.__rowOdds(holds, self.cardsRankGrid(ftr, runouts, holds),
+                                  self.cardsRankGrid(ftr, runouts, [hold])[:, 0],
+                                  np.ones((1, len(holds)), dtype = bool), playerCount)
+            odds = tuple(float(p[0]) for p in odds)
+        self.cache.put(key, odds)
+        return odds
+
+    # Exact odds for each row of a grid of final boards
+    # holds: opponent holds, ranks: theirs per row, myRanks: ours per row
+    # live: holds clear of the cards that row adds to the board
+    # Return: (win, tie, lose) arrays, one probability per row
+    def __rowOdds(self, holds, ranks, myRanks, live, playerCount):
+        worse = live & (ranks > myRanks[:, None])
+        ties = live & (ranks == myRanks[:, None])
+        if playerCount == 1:
+            total = live.sum(axis = 1).astype(float)
+            win = worse.sum(axis = 1) / total
+            tie = ties.sum(axis = 1) / total
+            return win, tie, (live & (ranks < myRanks[:, None])).sum(axis = 1) / total
+        # disjoint pairs of holds out of a set: all pairs less those
+        # sharing a card, two holds share at most one
+        cardHolds = np.zeros((len(holds), 52))
+        cardHolds[np.arange(len(holds)), holds[:, 0]] = 1
+        cardHolds[np.arange(len(holds)), holds[:, 1]] = 1
+        def pairs(held):
+            n = held.sum(axis = 1).astype(float)
+            perCard = held.dot(cardHolds)
+            return n * (n - 1) / 2 - (perCard * (perCard - 1) / 2).sum(axis = 1)
+        total = pairs(live)
+        win = pairs(worse) / total
+        notLose = pairs(worse | ties) / total
+        return win, notLose - win, 1.0 - notLose
 
-    # ftr/cards: (int<card>, ...)
+    # Grid cells lookahead evaluates on ftr, None if it can't: every next
+    # card (and on the flop every river after it) against every hold
+    def lookaheadSize(self, ftr):
+        if np is None or len(ftr) not in (3, 4):
+            return None
+        rest = 50 - len(ftr)
+        rows = rest if len(ftr) == 4 else rest * (rest - 1) + rest
+        return rows * self.C(rest, 2)
+
+    # Every card that can come next, in one pass over the final boards:
+    # the 46 rivers on the turn, the 47 turns on the flop. Next cards that
+    # are the same up to suits are done once. Each entry and the odds of
+    # the street we are on go to the cache, so the next street's
+    # loseTieRate and exactOdds are lookups, and so is exactOdds now.
+    # hold/ftr: (int<card>, ...), ftr of 3 or 4 cards
+    # playerCounts: opponent counts to get odds for, 1 and 2 only
+    # Return: {card: (our rank, lose%, tie% as loseTieRate,
+    #                 {playerCount: (win, tie, lose) as exactOdds})}
+    # with the board ftr + card; None if lookaheadSize is None or over
+    # lookaheadLimit, or the deadline passed between chunks
+    def lookahead(self, hold, ftr, playerCounts = (1, 2)):
+        size = self.lookaheadSize(ftr)
+        if size is None or size > self.lookaheadLimit:
+            return None
+        playerCounts = [count for count in playerCounts if 1 <= count <= 2]
+        done = self.__lookahead(hold, ftr, playerCounts)
+        return done[0] if done is not None else None
+
+    # Return: (lookahead table, {playerCount: exactOdds on ftr}), None
+    # if it stopped at expired() before a flop chunk
+    def __lookahead(self, hold, ftr, playerCounts):
+        rest = self.restCards(hold + ftr)
+        # next cards giving the same situation up to suits: key => [card, ...]
+        classes = collections.OrderedDict()
+        for card in rest:
+            classes.setdefault(self.canonical(hold, ftr + (card,)), []).append(card)
+        nexts = np.array([cards[0] for cards in classes.itervalues()])
+        weights = np.array([len(cards) for cards in classes.itervalues()], dtype = float)
+        holds = np.array(list(itertools.combinations(rest, 2)))
+
+        def grid(runouts):
+            live = np.ones((len(runouts), len(holds)), dtype = bool)
+            for card in runouts.T:
+                live &= (holds[None, :, 0] != card[:, None]) & (holds[None, :, 1] != card[:, None])
+            return (self.cardsRankGrid(ftr, runouts, holds),
+                    self.cardsRankGrid(ftr, runouts, [hold])[:, 0], live)
+
+        # the board with the next card: our rank, heads-up rates there
+        nextRanks, nextMine, nextLive = grid(nexts[:, None])
+        win, nextTie, nextLose = self.__rowOdds(holds, nextRanks, nextMine, nextLive, 1)
+        # the final boards, rows grouped by next card; on the flop a grid
+        # of chunk rows at a time, only the per row odds are kept. Each
+        # flop chunk first checks expired().
+        if len(ftr) == 4:
+            starts = [None]
+            groups = np.arange(len(nexts))
+        else:
+            runouts = np.array([(turn, river) for turn in nexts
+                                for river in rest if river != turn])
+            chunk = max(1, self.lookaheadChunk / len(holds))
+            starts = xrange(0, len(runouts), chunk)
+            groups = np.repeat(np.arange(len(nexts)), len(rest) - 1)
+        rows = np.bincount(groups).astype(float)
+
+        # playerCount => [[win rows, ...], [tie rows, ...], [lose rows, ...]]
+        parts = dict((playerCount, ([], [], [])) for playerCount in playerCounts)
+        for start in starts:
+            if start is None:
+                ranks, mine, live = nextRanks, nextMine, nextLive
+            elif self.expired():
+                return None
+            else:
+                ranks, mine, live = grid(runouts[start:start + chunk])
+            for playerCount in playerCounts:
+                for part, p in zip(parts[playerCount],
+                                   self.__rowOdds(holds, ranks, mine, live, playerCount)):
+                    part.append(p)
+        odds = {}
+        for playerCount in playerCounts:
+            odds[playerCount] = [np.bincount(groups, np.concatenate(part)) / rows
+                                 for part in parts[playerCount]]
+        table = {}
+        for idx, cards in enumerate(classes.itervalues()):
+            entry = (int(nextMine[idx]), float(nextLose[idx] * 100), float(nextTie[idx] * 100),
+                     dict((playerCount, tuple(float(p[idx]) for p in ps))
+                          for playerCount, ps in odds.iteritems()))
+            for card in cards:
+                table[card] = entry
+        self.storeLookahead(hold, ftr, table)
+        streetOdds = {}
+        for playerCount, ps in odds.iteritems():
+            streetOdds[playerCount] = tuple(float((weights * p).sum() / weights.sum()) for p in ps)
+            self.cache.put(('exactOdds',) + self.canonical(hold, ftr) + (playerCount,),
+                           streetOdds[playerCount])
+        return table, streetOdds
+
+    # Put a lookahead table for hold/ftr in the cache
+    def storeLookahead(self, hold, ftr, table):
+        done = set()
+        for card, (rank, lose, tie, odds) in table.iteritems():
+            key = self.canonical(hold, ftr + (card,))
+            if key in done:
+                continue
+            done.add(key)
+            self.cache.put(('loseTieRate',) + key, (lose, tie))
+            for playerCount, entry in odds.iteritems():
+                self.cache.put(('exactOdds',) + key + (playerCount,), entry)
+
+    # One trial: deal the rest of the board, then playerCount holds
+    # board: boardState(ftr), hold: (int<card>, int<card>)
+    # usedMask: cardsMask of hold and ftr
     # Return: 1 if win, else 0
-    def emulate(self, myRank, ftr, cards, playerCount):
-        ftr = list(ftr)
-        cards = list(cards)
-        ftr += self.randomChoose(self.restCards(cards), 5 - len(ftr))
-        players = [[]] * playerCount
-        usedCards = []
-        minRank = self.maxRank
+    def emulate(self, board, hold, usedMask, playerCount):
+        drawn = self.randomChoose(usedMask, 5 - len(board.cards))
+        if drawn:
+            board = board.copy()
+            for card in drawn:
+                board.add(card)
+                usedMask |= CARD_BIT[card]
+        myRank = board.evaluate_with(hold[0], hold[1])
         for idx in range(playerCount):
-            players[idx] = self.randomChoose(self.restCards(cards + ftr + usedCards), 2)
-            rank = self.cardsRank(tuple(ftr + players[idx]))
-            if rank < minRank:
-                minRank = rank
-            usedCards += players[idx]
-        if myRank < minRank:
-            return 1
-        else:
-            return 0
+            player = self.randomChoose(usedMask, 2)
+            usedMask |= CARD_BIT[player[0]] | CARD_BIT[player[1]]
+            if board.evaluate_with(player[0], player[1]) <= myRank:
+                return 0
+        return 1
         
     # Hand Strength
-    # hold/ftr: ((string<color>, int<point>), ...)
+    # hold/ftr: (int<card>, ...)
+    # Cached per emulateCount, a sample of another size is another value
     def HS(self, hold, ftr, playerCount):
-        hold = self.toOrigin(hold)
-        ftr = self.toOrigin(ftr)
-        cards = hold + ftr
-        myRank = self.cardsRank(tuple(cards))
-        winCount = 0
-        for idx in range(self.emulateCount):
-            winCount += self.emulate(myRank, tuple(ftr), tuple(cards), playerCount)
+        key = ('HS',) + self.canonical(hold, ftr) + (playerCount, self.emulateCount)
+        hs = self.cache.get(key)
+        if hs is None:
+            odds = self.exactOdds(hold, ftr, playerCount)
+            hs = odds[0] if odds is not None else self.emulateHS(hold, ftr, playerCount)
+            self.cache.put(key, hs)
+        return hs
+
+    # HS without the cache
+    def emulateHS(self, hold, ftr, playerCount):
+        winCount = self.emulateWins(hold, ftr, playerCount, self.emulateCount)
         return winCount * 1.000 / self.emulateCount
 
+    # Return: wins out of count emulate trials, all of them when no
+    # opponent is left
+    def emulateWins(self, hold, ftr, playerCount, count):
+        if playerCount < 1:
+            return count
+        if self.pool is not None and count >= self.poolTrials:
+            return self.pool.emulateWins(hold, ftr, playerCount, count,
+                                         self.random.getrandbits(31), self.deadline)
+        if np is not None:
+            return self.__emulateWinsBatch(hold, ftr, playerCount, count)
+        board = self.boardState(ftr)
+        usedMask = self.cardsMask(hold + tuple(ftr))
+        winCount = 0
+        for idx in xrange(count):
+            winCount += self.emulate(board, hold, usedMask, playerCount)
+        return winCount
+
+    # emulateWins in bulk. Each trial deals from its own row of a tiled
+    # deck with a partial Fisher-Yates shuffle, one column swap per card
+    # dealt; boards and opponents are then ranked in two evaluate_batch
+    # calls and winners found with a min over opponents.
+    def __emulateWinsBatch(self, hold, ftr, playerCount, count):
+        rest = np.array(self.restCards(hold + tuple(ftr)), dtype = np.int64)
+        drawn = 5 - len(ftr)
+        dealt = drawn + 2 * playerCount
+        wins = 0
+        for start in xrange(0, count, self.emulateChunk):
+            n = min(self.emulateChunk, count - start)
+            deck = np.tile(rest, (n, 1))
+            rows = np.arange(n)
+            for idx in xrange(dealt):
+                swap = self.rng.randint(idx, len(rest), n)
+                card = deck[rows, swap]
+                deck[rows, swap] = deck[:, idx]
+                deck[:, idx] = card
+            board = np.hstack([np.tile(np.array(ftr, dtype = np.int64), (n, 1)),
+                               deck[:, :drawn]])
+            myRanks = self.cardsRankBatch(np.hstack([board, np.tile(hold, (n, 1))]))
+            ranks = self.cardsRankBatch(np.hstack([
+                np.repeat(board, playerCount, axis = 0),
+                deck[:, drawn:dealt].reshape(n * playerCount, 2)]))
+            wins += int((myRanks < ranks.reshape(n, playerCount).min(axis = 1)).sum())
+        return wins
+
+    # True once self.deadline has passed or self.interrupt says so
+    def expired(self):
+        if self.interrupt is not None and self.interrupt():
+            return True
+        return self.deadline is not None and time.time() >= self.deadline
+
+    # Wilson score interval of a win rate
+    # Return: (low, high)
+    def confidence(self, wins, samples, z = 1.96):
+        if samples == 0:
+            return 0.0, 1.0
+        p = wins * 1.0 / samples
+        zz = z * z / samples
+        center = (p + zz / 2) / (1 + zz)
+        half = z * math.sqrt(p * (1 - p) / samples + zz / samples / 4) / (1 + zz)
+        return max(0.0, center - half), min(1.0, center + half)
+
+    # Sequential HS: batches of emulateBatch trials (poolBatch per worker
+    # with a pool) until the confidence
+    # interval clears every threshold (HS values where the caller's
+    # decision changes), or is within +-precision, or emulateMax trials
+    # ran, or self.deadline passed. Trials are cached, a later call on the
+    # same spot resumes them. Spots exactOdds can do are not sampled.
+    # Return: (HS, samples, (low, high)), samples 0 when exact
+    def adaptiveHS(self, hold, ftr, playerCount, thresholds = (), precision = 0.02):
+        odds = self.exactOdds(hold, ftr, playerCount)
+        if odds is not None:
+            return odds[0], 0, (odds[0], odds[0])
+        key = ('adaptiveHS',) + self.canonical(hold, ftr) + (playerCount,)
+        wins, samples = self.cache.get(key) or (0, 0)
+        batch = self.emulateBatch if self.pool is None else self.poolBatch * self.pool.workers
+        while True:
+            low, high = self.confidence(wins, samples)
+            if samples:
+                if high - low <= 2 * precision or samples >= self.emulateMax:
+                    break
+                if self.expired():
+                    break
+                if thresholds and not [t for t in thresholds if low < t < high]:
+                    break
+            count = min(batch, max(self.emulateBatch, self.emulateMax - samples))
+            wins += self.emulateWins(hold, ftr, playerCount, count)
+            samples += count
+        self.cache.put(key, (wins, samples))
+        return wins * 1.0 / samples, samples, (low, high)
+
+    # Take over work done for hold/ftr elsewhere (EquitySpeculator):
+    # boardRanks for loseRate, {playerCount: (win, tie, lose)} for
+    # exactOdds, {playerCount: (wins, samples)} for adaptiveHS, a
+    # lookahead table for the next street.
+    # Sample counts are kept, not added, so merging twice is harmless.
+    def merge(self, hold, ftr, boardRanks, exact, results, table = None):
+        if boardRanks is not None and (self.lastBoardRanks is None or
+                                       self.lastBoardRanks.board != boardRanks.board):
+            self.lastBoardRanks = boardRanks
+        if table and table is not self.lastLookahead:
+            self.storeLookahead(hold, ftr, table)
+            self.lastLookahead = table
+        for playerCount, odds in exact.iteritems():
+            if odds is not None:
+                self.cache.put(('exactOdds',) + self.canonical(hold, ftr) + (playerCount,), odds)
+        for playerCount, (wins, samples) in results.iteritems():
+            if not samples:
+                continue
+            key = ('adaptiveHS',) + self.canonical(hold, ftr) + (playerCount,)
+            cached = self.cache.get(key)
+            if cached is None or cached[1] < samples:
+                self.cache.put(key, (wins, samples))
+
+    def close(self):
+        if self.pool is not None and self.ownPool:
+            self.pool.close()
+
     # Rate of Return
     def RR(self, hold, ftr, playerCount, bet, pot):
         if bet == 0:
@@ -231,7 +897,143 @@ class PokerUtils:
         HS = self.HS(hold, ftr, playerCount)
         return HS * (bet + pot) / bet, HS
         
+
+# Works on loseRate and HS for the current street on a background thread
+# while we wait for the inquire. start/cancel bump the generation, so a
+# batch finished for an old street is thrown away; a lookahead stops at
+# its next chunk once the generation changes or we pause. Uses its own
+# PokerUtils, nothing is shared with the deciding thread but the results.
+class EquitySpeculator:
+    def __init__(self):
+        self.pu = PokerUtils()
+        self.pu.interrupt = self.__stopped
+        self.lock = threading.Lock()
+        # set while there is work and we are not paused
+        self.wake = threading.Event()
+        self.generation = 0
+        # generation of the work in progress
+        self.running = 0
+        self.job = None
+        self.paused = False
+        self.closed = False
+        self.boardRanks = None
+        # lookahead table, False if there is none to make
+        self.table = None
+        # playerCount => (win, tie, lose), None if it has to be sampled
+        self.exact = {}
+        # playerCount => (wins, samples)
+        self.results = {}
+        self.thread = threading.Thread(target = self.__run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    # hold/ftr: (int<card>, ...)
+    # counts: opponent counts to sample, likeliest first
+    def start(self, hold, ftr, counts):
+        with self.lock:
+            self.generation += 1
+            self.job = (self.generation, hold, ftr, tuple(counts))
+            self.boardRanks = None
+            self.table = None
+            self.exact = {}
+            self.results = dict((count, (0, 0)) for count in counts)
+            if not self.paused:
+                self.wake.set()
+
+    def cancel(self):
+        with self.lock:
+            self.generation += 1
+            self.job = None
+            self.boardRanks = None
+            self.table = None
+            self.exact = {}
+            self.results = {}
+            self.wake.clear()
+
+    # Leave the CPU to a decision; batches stop at the next boundary
+    def pause(self):
+        with self.lock:
+            self.paused = True
+            self.wake.clear()
+
+    def resume(self):
+        with self.lock:
+            self.paused = False
+            if self.job is not None:
+                self.wake.set()
+
+    # Stops the thread after its current batch
+    def close(self):
+        self.cancel()
+        with self.lock:
+            self.closed = True
+            self.wake.set()
+        self.thread.join()
+
+    # Return: (BoardRanks or None, {playerCount: (win, tie, lose)},
+    # {playerCount: (wins, samples)}, lookahead table or None) done so
+    # far for hold/ftr
+    def take(self, hold, ftr):
+        with self.lock:
+            if self.job is None or self.job[1:3] != (hold, ftr):
+                return None, {}, {}, None
+            return (self.boardRanks, dict(self.exact), dict(self.results),
+                    self.table or None)
+
+    # Read without the lock, a stale answer costs one chunk at most
+    def __stopped(self):
+        return self.paused or self.generation != self.running
+
+    def __run(self):
+        while True:
+            self.wake.wait()
+            with self.lock:
+                if self.closed:
+                    return
+                if self.job is None or self.paused:
+                    continue
+                generation, hold, ftr, counts = self.job
+                self.running = generation
+                needBoard = len(ftr) >= 3 and self.boardRanks is None
+                needTable = self.table is None
+                unknown = [count for count in counts if count not in self.exact]
+                pending = [count for count in counts if self.exact.get(count, 0) is None
+                           and self.results[count][1] < self.pu.emulateMax]
+                if not needBoard and not needTable and not unknown and not pending:
+                    self.wake.clear()
+                    continue
+                if pending:
+                    # the count with the fewest samples, ties to the likeliest
+                    count = min(pending, key = lambda count: self.results[count][1])
+            if needBoard:
+                boardRanks = BoardRanks(self.pu, ftr)
+                with self.lock:
+                    if generation == self.generation:
+                        self.boardRanks = boardRanks
+                continue
+            if needTable:
+                # the odds of this street come with it
+                # None when paused mid-way too, then it runs again
+                table = self.pu.lookahead(hold, ftr, counts)
+                with self.lock:
+                    if generation == self.generation and (table is not None or not self.paused):
+                        self.table = table or False
+                continue
+            if unknown:
+                odds = self.pu.exactOdds(hold, ftr, unknown[0])
+                with self.lock:
+                    if generation == self.generation and (odds is not None or not self.paused):
+                        self.exact[unknown[0]] = odds
+                continue
+            wins = self.pu.emulateWins(hold, ftr, count, self.pu.emulateBatch)
+            with self.lock:
+                if generation == self.generation:
+                    total, samples = self.results[count]
+                    self.results[count] = (total + wins, samples + self.pu.emulateBatch)
+
 if __name__ == '__main__':
     pu = PokerUtils()
-    print(pu.loseRate((('DIAMONDS', 12), ('HEARTS', 10)), (('CLUBS', 5), ('DIAMONDS', 9), ('SPADES', 3))))
-    print(pu.HS((('DIAMONDS', 12), ('HEARTS', 10)), (('CLUBS', 5), ('DIAMONDS', 9), ('SPADES', 3)), 1))
+    hold = tuple(pu.toOrigin((('DIAMONDS', 12), ('HEARTS', 10))))
+    ftr = tuple(pu.toOrigin((('CLUBS', 5), ('DIAMONDS', 9), ('SPADES', 3))))
+    print(pu.loseRate(hold, ftr))
+    print(pu.HS(hold, ftr, 1))
@@ -51,6 +51,10 @@ class Card ():
      # hearts and diamonds
     PRETTY_REDS = [2, 4]
 
+    # index form: a card is also an int 0-51 = suit * 13 + rank,
+    # suits in this order
+    INDEX_SUITS = 'shcd'
+
     @staticmethod
     def new(string):
         """
@@ -71,6 +75,14 @@ class Card ():
 
         return bitrank | suit | rank | rank_prime
 
+    @staticmethod
+    def from_index(index):
+        """
+        Converts a card index (0-51) to the integer representation.
+        Card.INDEX_TO_INT holds all 52 of them.
+        """
+        return Card.new(Card.STR_RANKS[index % 13] + Card.INDEX_SUITS[index / 13])
+
     @staticmethod
     def int_to_str(card_int):
         rank_int = Card.get_rank_int(card_int)
@@ -212,3 +224,5 @@ class Card ():
                 output += Card.int_to_pretty_str(c) + " "
     
         print output
+
+Card.INDEX_TO_INT = [Card.from_index(index) for index in range(52)]
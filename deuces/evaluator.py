@@ -1,5 +1,9 @@
 import itertools
 from card import Card
+try:
+    import numpy as np
+except ImportError:
+    np = None
 from deck import Deck
 from lookup import LookupTable
 
@@ -14,15 +18,47 @@ class Evaluator(object):
     all calculations are done with bit arithmetic and table lookups. 
     """
 
-    def __init__(self):
+    MODES = ('combinations', 'direct')
 
-        self.table = LookupTable()
+    # one 4 bit counter per suit, indexed by the cdhs bits of a card
+    SUIT_COUNTERS = [0, 1 << 0, 1 << 4, 0, 1 << 8, 0, 0, 0, 1 << 12]
+
+    # counter with 5+ cards => suit bits of that flush
+    FLUSH_TO_SUIT = {
+        0x8 : 0x1000,
+        0x80 : 0x2000,
+        0x800 : 0x4000,
+        0x8000 : 0x8000
+    }
+
+    # per card index (see Card.INDEX_SUITS) for evaluate_index
+    INDEX_PRIMES = [Card.get_prime(c) for c in Card.INDEX_TO_INT]
+    INDEX_SUIT_COUNTERS = [SUIT_COUNTERS[Card.get_suit_int(c)] for c in Card.INDEX_TO_INT]
+
+    def __init__(self, mode='combinations'):
+        """
+        mode='combinations' evaluates 6 and 7 card hands as the best of 
+        their 5 card subsets, mode='direct' looks them up in one pass. 
+
+        Both share the process wide LookupTable, mapped from the prebuilt
+        table file, so constructing an Evaluator is nearly free.
+        """
+        assert mode in Evaluator.MODES, "Invalid evaluator mode"
+        self.mode = mode
+        self.table = LookupTable.shared()
         
-        self.hand_size_map = {
-            5 : self._five,
-            6 : self._six,
-            7 : self._seven
-        }
+        if mode == 'direct':
+            self.hand_size_map = {
+                5 : self._five,
+                6 : self._direct,
+                7 : self._direct
+            }
+        else:
+            self.hand_size_map = {
+                5 : self._five,
+                6 : self._six,
+                7 : self._seven
+            }
 
     def evaluate(self, cards):
         """
@@ -88,6 +124,159 @@ class Evaluator(object):
 
         return minimum
 
+    def _direct(self, cards):
+        """
+        Evaluates 5, 6 or 7 cards in a single pass. 
+
+        Suits are counted in four nibbles of one integer, adding 3 to each
+        nibble sets its high bit only when that suit has 5+ cards. A flush 
+        is then looked up by the rank bits of that suit, anything else by
+        the prime product of all the cards, through the perfect hash 
+        described in LookupTable.
+        """
+        suits = 0
+        product = 1
+        for c in cards:
+            suits += Evaluator.SUIT_COUNTERS[(c >> 12) & 0xF]
+            product *= c & 0xFF
+
+        flush = (suits + 0x3333) & 0x8888
+        if flush:
+            suit = Evaluator.FLUSH_TO_SUIT[flush]
+            handOR = 0
+            for c in cards:
+                if c & suit:
+                    handOR |= c
+            return self.table.flush_rankbits_lookup[handOR >> 16]
+
+        table = self.table
+        return table.unsuited_hash_values[
+            (product ^ table.unsuited_hash_disp[product % LookupTable.HASH_BUCKETS]) %
+            LookupTable.HASH_SIZE]
+
+    def evaluate_index(self, cards):
+        """
+        _direct for 5, 6 or 7 cards in index form (0-51), reading the 
+        per card values from tables instead of converting the cards.
+        """
+        assert 5 <= len(cards) <= 7, "Invalid hand length"
+        suits = 0
+        product = 1
+        for i in cards:
+            suits += Evaluator.INDEX_SUIT_COUNTERS[i]
+            product *= Evaluator.INDEX_PRIMES[i]
+
+        flush = (suits + 0x3333) & 0x8888
+        if flush:
+            suit = Evaluator.FLUSH_TO_SUIT[flush]
+            handOR = 0
+            for i in cards:
+                c = Card.INDEX_TO_INT[i]
+                if c & suit:
+                    handOR |= c
+            return self.table.flush_rankbits_lookup[handOR >> 16]
+
+        table = self.table
+        return table.unsuited_hash_values[
+            (product ^ table.unsuited_hash_disp[product % LookupTable.HASH_BUCKETS]) %
+            LookupTable.HASH_SIZE]
+
+    def hand_state(self, cards=()):
+        """
+        Incremental HandState for cards in index form (0-51), sharing 
+        this evaluator's tables.
+        """
+        return HandState(cards, self.table)
+
+    def evaluate_batch(self, cards):
+        """
+        Evaluates many hands at once. Expects an N x 5, 6 or 7 array of 
+        cards in integer form and returns the N ranks as a numpy array.
+
+        Same tables as the direct evaluator: flushes are indexed by rank 
+        bits, everything else goes through the prime product hash. 
+        Requires numpy.
+        """
+        if np is None:
+            raise ImportError("evaluate_batch requires numpy")
+        if not hasattr(self, 'batch_values'):
+            self._batch_tables()
+
+        cards = np.asarray(cards, dtype=np.int64)
+        if cards.ndim != 2 or cards.shape[1] not in (5, 6, 7):
+            raise ValueError("Expected an N x 5, 6 or 7 array of cards")
+
+        product = np.prod(cards & 0xFF, axis=1)
+        disp = self.batch_disp[product % LookupTable.HASH_BUCKETS]
+        ranks = self.batch_values[(product ^ disp) % LookupTable.HASH_SIZE].astype(np.int32)
+
+        suits = (cards >> 12) & 0xF
+        counters = (self.batch_suit_counters[suits].sum(axis=1) + 0x3333) & 0x8888
+        flush = counters != 0
+        if flush.any():
+            flushSuit = self.batch_flush_suit[counters[flush] >> 3] >> 12
+            bits = np.where(suits[flush] == flushSuit[:, None], cards[flush] >> 16, 0)
+            ranks[flush] = self.batch_flush[np.bitwise_or.reduce(bits, axis=1)]
+        return ranks
+
+    def evaluate_grid(self, board, rows, cols):
+        """
+        Evaluates board + rows[i] + cols[j] for every i and j, e.g. every 
+        river card against every opponent hold, without building the 
+        hands: prime products and suit counters are combined as an outer 
+        product, only cells that make a flush are evaluated in full.
+
+        board is a list of cards, rows and cols are lists of equally long 
+        card lists (which may be empty), each hand must come to 5-7 
+        cards. Returns a len(rows) x len(cols) numpy array of ranks. 
+        Requires numpy.
+        """
+        if np is None:
+            raise ImportError("evaluate_grid requires numpy")
+        if not hasattr(self, 'batch_values'):
+            self._batch_tables()
+
+        board = np.asarray(board, dtype=np.int64).reshape(-1)
+        rows = np.asarray(rows, dtype=np.int64).reshape(len(rows), -1)
+        cols = np.asarray(cols, dtype=np.int64).reshape(len(cols), -1)
+        if not 5 <= len(board) + rows.shape[1] + cols.shape[1] <= 7:
+            raise ValueError("Expected hands of 5, 6 or 7 cards")
+
+        product = np.prod(board & 0xFF) * \
+            np.prod(rows & 0xFF, axis=1)[:, None] * np.prod(cols & 0xFF, axis=1)[None, :]
+        disp = self.batch_disp[product % LookupTable.HASH_BUCKETS]
+        ranks = self.batch_values[(product ^ disp) % LookupTable.HASH_SIZE].astype(np.int32)
+
+        def counter(cards):
+            return self.batch_suit_counters[(cards >> 12) & 0xF].sum(axis=-1)
+        counters = (counter(board) + counter(rows)[:, None] +
+                    counter(cols)[None, :] + 0x3333) & 0x8888
+        i, j = np.nonzero(counters)
+        if len(i):
+            ranks[i, j] = self.evaluate_batch(np.hstack([
+                np.tile(board, (len(i), 1)), rows[i], cols[j]]))
+        return ranks
+
+    def _batch_tables(self):
+        """
+        numpy views of the direct tables for evaluate_batch, straight on
+        the mapped file when the table was loaded from one.
+        """
+        def view(name, values):
+            if hasattr(self.table, 'mapped'):
+                typecode, items, offset = self.table.sections[name]
+                return np.frombuffer(self.table.mapped, dtype='<u2',
+                                     count=items, offset=offset)
+            return np.frombuffer(values, dtype=np.uint16)
+
+        self.batch_flush = view('flush_rankbits', self.table.flush_rankbits_lookup)
+        self.batch_disp = view('unsuited_disp', self.table.unsuited_hash_disp)
+        self.batch_values = view('unsuited_hash', self.table.unsuited_hash_values)
+        self.batch_suit_counters = np.array(Evaluator.SUIT_COUNTERS, dtype=np.int64)
+        self.batch_flush_suit = np.zeros(0x8000 >> 3 | 1, dtype=np.int64)
+        for flush, suit in Evaluator.FLUSH_TO_SUIT.iteritems():
+            self.batch_flush_suit[flush >> 3] = suit
+
     def get_rank_class(self, hr):
         """
         Returns the class of hand given the hand hand_rank
@@ -185,3 +374,84 @@ class Evaluator(object):
 
 
 
+
+
+# per index card, bound at module level for HandState's inner loops
+_INDEX_PRIMES = Evaluator.INDEX_PRIMES
+_INDEX_SUIT_COUNTERS = Evaluator.INDEX_SUIT_COUNTERS
+_INDEX_SUIT = [i / 13 for i in range(52)]
+_INDEX_RANKBIT = [1 << (i % 13) for i in range(52)]
+# counter with 5+ cards => index suit of that flush
+_FLUSH_TO_INDEX_SUIT = dict((_INDEX_SUIT_COUNTERS[s * 13] << 3, s) for s in range(4))
+_HASH_BUCKETS = LookupTable.HASH_BUCKETS
+_HASH_SIZE = LookupTable.HASH_SIZE
+
+class HandState(object):
+    """
+    Evaluation state of a growing set of cards in index form (0-51), such
+    as the board of the hand in play: the prime product, the packed suit
+    counters and the rank bits of each suit. Adding a card is O(1), and so 
+    is evaluating the cards plus two more (a hold against the board), 
+    which is all _direct would do over the whole hand.
+    """
+
+    __slots__ = ('table', 'cards', 'product', 'suits', 'rankbits')
+
+    def __init__(self, cards=(), table=None):
+        self.table = table or LookupTable.shared()
+        self.cards = ()
+        self.product = 1
+        self.suits = 0
+        self.rankbits = [0, 0, 0, 0]
+        for i in cards:
+            self.add(i)
+
+    def add(self, i):
+        self.cards += (i,)
+        self.product *= _INDEX_PRIMES[i]
+        self.suits += _INDEX_SUIT_COUNTERS[i]
+        self.rankbits[_INDEX_SUIT[i]] |= _INDEX_RANKBIT[i]
+
+    def copy(self):
+        state = HandState.__new__(HandState)
+        state.table = self.table
+        state.cards = self.cards
+        state.product = self.product
+        state.suits = self.suits
+        state.rankbits = self.rankbits[:]
+        return state
+
+    def evaluate(self):
+        """
+        Rank of the cards held, 5-7 of them.
+        """
+        flush = (self.suits + 0x3333) & 0x8888
+        if flush:
+            return self.table.flush_rankbits_lookup[
+                self.rankbits[_FLUSH_TO_INDEX_SUIT[flush]]]
+        return self._unsuited(self.product)
+
+    def evaluate_with(self, a, b):
+        """
+        Rank of the cards held plus cards a and b, 5-7 in all, without
+        adding them.
+        """
+        flush = (self.suits + _INDEX_SUIT_COUNTERS[a] +
+                 _INDEX_SUIT_COUNTERS[b] + 0x3333) & 0x8888
+        if flush:
+            suit = _FLUSH_TO_INDEX_SUIT[flush]
+            bits = self.rankbits[suit]
+            if _INDEX_SUIT[a] == suit:
+                bits |= _INDEX_RANKBIT[a]
+            if _INDEX_SUIT[b] == suit:
+                bits |= _INDEX_RANKBIT[b]
+            return self.table.flush_rankbits_lookup[bits]
+        product = self.product * _INDEX_PRIMES[a] * _INDEX_PRIMES[b]
+        table = self.table
+        return table.unsuited_hash_values[
+            (product ^ table.unsuited_hash_disp[product % _HASH_BUCKETS]) % _HASH_SIZE]
+
+    def _unsuited(self, product):
+        table = self.table
+        return table.unsuited_hash_values[
+            (product ^ table.unsuited_hash_disp[product % _HASH_BUCKETS]) % _HASH_SIZE]
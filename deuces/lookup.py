@@ -1,4 +1,4 @@
-import itertools
+import array, itertools, mmap, os, struct, zlib
 from card import Card
 
 class LookupTable(object):
@@ -46,6 +46,20 @@ class LookupTable(object):
         MAX_HIGH_CARD: 9
     }
 
+    # straight flush rank bits in rank order
+    STRAIGHT_FLUSHES = [
+        7936, # int('0b1111100000000', 2), # royal flush
+        3968, # int('0b111110000000', 2),
+        1984, # int('0b11111000000', 2),
+        992, # int('0b1111100000', 2),
+        496, # int('0b111110000', 2),
+        248, # int('0b11111000', 2),
+        124, # int('0b1111100', 2),
+        62, # int('0b111110', 2),
+        31, # int('0b11111', 2),
+        4111 # int('0b1000000001111', 2) # 5 high
+    ]
+
     RANK_CLASS_TO_STRING = {
         1 : "Straight Flush",
         2 : "Four of a Kind",
@@ -58,9 +72,36 @@ class LookupTable(object):
         9 : "High Card"
     }
 
-    def __init__(self):
+    # unsuited_best_lookup is stored as a perfect hash on the prime 
+    # product: product % HASH_BUCKETS picks a displacement d and the 
+    # rank is at (product ^ d) % HASH_SIZE (both primes, ~1.25 slots 
+    # per hand)
+    HASH_BUCKETS = 32749
+    HASH_SIZE = 92221
+
+    # binary table file, see save() and load()
+    FILE_MAGIC = 'DEUCESLT'
+    FILE_VERSION = 1
+    FILE_HEADER = struct.Struct('<8sIII')       # magic, version, sections, crc32
+    FILE_SECTION = struct.Struct('<16scIQ')     # name, typecode, count, offset
+    FILE_SECTIONS = [
+        # name, typecode
+        ('flush_keys', 'I'),
+        ('flush_ranks', 'H'),
+        ('unsuited_keys', 'I'),
+        ('unsuited_ranks', 'H'),
+        ('flush_rankbits', 'H'),
+        ('unsuited_disp', 'H'),
+        ('unsuited_hash', 'H')
+    ]
+    DEFAULT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tables.bin')
+
+    _shared = None
+
+    def __init__(self, direct=False):
         """
-        Calculates lookup tables
+        Calculates lookup tables. With direct=True the six and seven card
+        tables used by the direct evaluator are built as well.
         """
         # create dictionaries
         self.flush_lookup = {}
@@ -71,6 +112,9 @@ class LookupTable(object):
                         # we reuse some of the bit sequences
         self.multiples()
 
+        if direct:
+            self.sevens()
+
     def flushes(self):
         """
         Straight flushes and flushes. 
@@ -80,18 +124,7 @@ class LookupTable(object):
         """
 
         # straight flushes in rank order
-        straight_flushes = [
-            7936, # int('0b1111100000000', 2), # royal flush
-            3968, # int('0b111110000000', 2),
-            1984, # int('0b11111000000', 2),
-            992, # int('0b1111100000', 2),
-            496, # int('0b111110000', 2),
-            248, # int('0b11111000', 2),
-            124, # int('0b1111100', 2),
-            62, # int('0b111110', 2),
-            31, # int('0b11111', 2),
-            4111 # int('0b1000000001111', 2) # 5 high
-        ]
+        straight_flushes = LookupTable.STRAIGHT_FLUSHES
 
         # now we'll dynamically generate all the other
         # flushes (including straight flushes)
@@ -247,6 +280,210 @@ class LookupTable(object):
                 self.unsuited_lookup[product] = rank
                 rank += 1
 
+    def sevens(self):
+        """
+        Tables for evaluating 5, 6 or 7 cards in one pass.
+
+        flush_rankbits_lookup is indexed by the rank bits of the cards of 
+        a single suit and holds the best (straight) flush among them, or 0
+        when fewer than 5 bits are set. 
+
+        unsuited_best_lookup maps the prime product of 5, 6 or 7 cards to 
+        the best 5 card rank they contain. Every 6 card hand is some 5 card
+        hand plus one more rank, so we grow the table one card at a time 
+        and keep the minimum - no combinations needed.
+        """
+        self.flush_rankbits_lookup = array.array('H', [0]) * (1 << len(Card.INT_RANKS))
+        for bits in xrange(len(self.flush_rankbits_lookup)):
+            if bin(bits).count('1') < 5:
+                continue
+
+            best = 0
+            for sf in LookupTable.STRAIGHT_FLUSHES:
+                if bits & sf == sf:
+                    best = self.flush_lookup[Card.prime_product_from_rankbits(sf)]
+                    break
+
+            # no straight flush, keep the five highest ranks
+            if not best:
+                top = bits
+                while bin(top).count('1') > 5:
+                    top &= top - 1
+                best = self.flush_lookup[Card.prime_product_from_rankbits(top)]
+            self.flush_rankbits_lookup[bits] = best
+
+        self.unsuited_best_lookup = dict(self.unsuited_lookup)
+        hands = self.unsuited_lookup
+        for size in (6, 7):
+            bigger = {}
+            for product, rank in hands.iteritems():
+                for prime in Card.PRIMES:
+                    # at most four cards of a rank
+                    if product % prime**4 == 0:
+                        continue
+                    key = product * prime
+                    if rank < bigger.get(key, LookupTable.MAX_HIGH_CARD + 1):
+                        bigger[key] = rank
+            self.unsuited_best_lookup.update(bigger)
+            hands = bigger
+
+        self.unsuited_hash()
+
+    def unsuited_hash(self):
+        """
+        Packs unsuited_best_lookup into two flat arrays (hash and 
+        displace): unsuited_hash_disp, one entry per bucket, and 
+        unsuited_hash_values, indexed as described at HASH_BUCKETS. 
+
+        Buckets are placed biggest first, each trying displacements 
+        until all of its keys land on free slots.
+        """
+        size = LookupTable.HASH_SIZE
+        buckets = [[] for i in xrange(LookupTable.HASH_BUCKETS)]
+        for product, rank in self.unsuited_best_lookup.iteritems():
+            buckets[product % LookupTable.HASH_BUCKETS].append((product, rank))
+
+        self.unsuited_hash_disp = array.array('H', [0]) * len(buckets)
+        self.unsuited_hash_values = array.array('H', [0]) * size
+        taken = bytearray(size)
+        order = sorted(xrange(len(buckets)), key=lambda b: -len(buckets[b]))
+        for b in order:
+            if not buckets[b]:
+                break
+            d = 0
+            while True:
+                slots = [(x ^ d) % size for x, rank in buckets[b]]
+                if len(set(slots)) == len(slots) and \
+                        not any(taken[slot] for slot in slots):
+                    break
+                d += 1
+            assert d <= 0xFFFF, "displacement %d does not fit the 'H' array" % d
+            self.unsuited_hash_disp[b] = d
+            for slot, (x, rank) in zip(slots, buckets[b]):
+                taken[slot] = 1
+                self.unsuited_hash_values[slot] = rank
+
+    def save(self, filepath):
+        """
+        Writes all the tables to a binary file that load() can map:
+
+            header   magic, version, section count, crc32 of the rest
+            sections name, typecode, item count, offset from file start
+            payload  little endian arrays, 8 byte aligned
+
+        The file is written next to its final path and renamed into 
+        place, so readers never see half a file.
+        """
+        if not hasattr(self, 'unsuited_hash_values'):
+            self.sevens()
+
+        flush = sorted(self.flush_lookup.iteritems())
+        unsuited = sorted(self.unsuited_lookup.iteritems())
+        data = {
+            'flush_keys': [k for k, v in flush],
+            'flush_ranks': [v for k, v in flush],
+            'unsuited_keys': [k for k, v in unsuited],
+            'unsuited_ranks': [v for k, v in unsuited],
+            'flush_rankbits': self.flush_rankbits_lookup,
+            'unsuited_disp': self.unsuited_hash_disp,
+            'unsuited_hash': self.unsuited_hash_values
+        }
+
+        offset = LookupTable.FILE_HEADER.size + \
+                 LookupTable.FILE_SECTION.size * len(LookupTable.FILE_SECTIONS)
+        sections = []
+        payload = []
+        for name, typecode in LookupTable.FILE_SECTIONS:
+            pad = -offset % 8
+            offset += pad
+            values = struct.pack('<%d%s' % (len(data[name]), typecode), *data[name])
+            payload.append('\0' * pad + values)
+            sections.append(LookupTable.FILE_SECTION.pack(
+                name, typecode, len(data[name]), offset))
+            offset += len(values)
+
+        body = ''.join(sections) + ''.join(payload)
+        header = LookupTable.FILE_HEADER.pack(LookupTable.FILE_MAGIC,
+            LookupTable.FILE_VERSION, len(sections), zlib.crc32(body) & 0xFFFFFFFF)
+
+        tmppath = '%s.%d.tmp' % (filepath, os.getpid())
+        with open(tmppath, 'wb') as f:
+            f.write(header + body)
+        os.rename(tmppath, filepath)
+
+    @staticmethod
+    def load(filepath):
+        """
+        Maps a file written by save() read only. The numpy views used by
+        evaluate_batch point straight into the mapped pages, which are 
+        shared by every process on the host. The scalar path gets plain 
+        array copies of them (about 260KB per process, not shared) and 
+        only the small 5 card dictionaries are rebuilt, so without numpy 
+        the file only saves the build time. 
+
+        Raises ValueError if the file is not a valid table file for this
+        version, IOError if it can't be read.
+        """
+        with open(filepath, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        headerSize = LookupTable.FILE_HEADER.size
+        if len(mapped) < headerSize:
+            raise ValueError("Table file too short: %s" % filepath)
+        magic, version, count, crc = LookupTable.FILE_HEADER.unpack_from(mapped, 0)
+        if magic != LookupTable.FILE_MAGIC or version != LookupTable.FILE_VERSION:
+            raise ValueError("Not a version %d table file: %s" %
+                             (LookupTable.FILE_VERSION, filepath))
+        if zlib.crc32(mapped[headerSize:]) & 0xFFFFFFFF != crc:
+            raise ValueError("Table file checksum mismatch: %s" % filepath)
+
+        table = LookupTable.__new__(LookupTable)
+        table.mapped = mapped
+        table.sections = {}
+        for i in xrange(count):
+            name, typecode, items, offset = LookupTable.FILE_SECTION.unpack_from(
+                mapped, headerSize + i * LookupTable.FILE_SECTION.size)
+            table.sections[name.rstrip('\0')] = (typecode, items, offset)
+
+        def section(name):
+            typecode, items, offset = table.sections[name]
+            values = array.array(typecode)
+            values.fromstring(mapped[offset:offset + items * values.itemsize])
+            return values
+
+        table.flush_lookup = dict(itertools.izip(
+            section('flush_keys'), section('flush_ranks')))
+        table.unsuited_lookup = dict(itertools.izip(
+            section('unsuited_keys'), section('unsuited_ranks')))
+        table.flush_rankbits_lookup = section('flush_rankbits')
+        table.unsuited_hash_disp = section('unsuited_disp')
+        table.unsuited_hash_values = section('unsuited_hash')
+        if len(table.unsuited_hash_disp) != LookupTable.HASH_BUCKETS or \
+                len(table.unsuited_hash_values) != LookupTable.HASH_SIZE:
+            raise ValueError("Table file hash size mismatch: %s" % filepath)
+        return table
+
+    @staticmethod
+    def shared(filepath=None):
+        """
+        One complete table per process, shared by every Evaluator. 
+
+        Loaded from the table file when there is a valid one, otherwise 
+        built and saved there for the next process (best effort).
+        """
+        if LookupTable._shared is None:
+            filepath = filepath or LookupTable.DEFAULT_FILE
+            try:
+                LookupTable._shared = LookupTable.load(filepath)
+            except (IOError, ValueError):
+                table = LookupTable(direct=True)
+                try:
+                    table.save(filepath)
+                except (IOError, OSError):
+                    pass
+                LookupTable._shared = table
+        return LookupTable._shared
+
     def write_table_to_disk(self, table, filepath):
         """
         Writes lookup table to disk
@@ -269,4 +506,11 @@ class LookupTable(object):
         while True:
             t = (next | (next - 1)) + 1 
             next = t | ((((t & -t) / (next & -next)) >> 1) - 1)
-            yield next
\ No newline at end of file
+            yield next
+
+if __name__ == '__main__':
+    # prebuild the table file: python -m deuces.lookup [filepath]
+    import sys
+    filepath = sys.argv[1] if len(sys.argv) > 1 else LookupTable.DEFAULT_FILE
+    LookupTable(direct=True).save(filepath)
+    print "wrote %s" % filepath